@@ -0,0 +1,26 @@
+-- Per-project and per-availability zone daily usage rollups.
+--
+-- The rollups are generated from the instance data, so the instance table
+-- needs a full update to fill in the history.
+--
+-- backfill: instance
+
+create table if not exists historical_usage_project (
+        day date comment 'Day this usage record applies to',
+        project_id varchar(36) comment 'Project UUID',
+        vcpus int comment 'Allocated number of vCPUs',
+        memory int comment 'Allocated memory in MB',
+        local_storage int comment 'Allocated local storage (root+ephemeral) in GB',
+        primary key (day, project_id),
+        key historical_usage_project_key (project_id, day)
+) comment 'Daily snapshots of resource usage by project';
+
+create table if not exists historical_usage_az (
+        day date comment 'Day this usage record applies to',
+        availability_zone varchar(255) comment 'Availability zone',
+        vcpus int comment 'Allocated number of vCPUs',
+        memory int comment 'Allocated memory in MB',
+        local_storage int comment 'Allocated local storage (root+ephemeral) in GB',
+        primary key (day, availability_zone),
+        key historical_usage_az_key (availability_zone, day)
+) comment 'Daily snapshots of resource usage by availability zone';
@@ -0,0 +1,20 @@
+-- Hypervisor utilisation time series. There's no history to backfill - the
+-- samples start with the next pollster run.
+
+create table if not exists hypervisor_utilisation (
+        host varchar(255) comment 'Host name, same as hypervisor.host',
+        resolution int comment 'Sample period in seconds, 0 for raw samples',
+        sample_time datetime comment 'Start of the sample period',
+        samples int comment 'Number of raw samples averaged in this record',
+        cpus float comment 'Number of installed CPU cores',
+        vcpus_allocated float comment 'vCPUs allocated to live instances',
+        vcpus_used float comment 'vCPUs in use, as reported by nova',
+        memory float comment 'Total installed memory in MB',
+        memory_allocated float comment 'Memory allocated to live instances in MB',
+        memory_used float comment 'Memory in use in MB, as reported by nova',
+        local_storage float comment 'Total local disk in GB',
+        local_storage_allocated float comment 'Local disk allocated to live instances in GB',
+        local_storage_used float comment 'Local disk in use in GB, as reported by nova',
+        primary key (host, resolution, sample_time),
+        key hypervisor_utilisation_time_key (resolution, sample_time)
+) comment 'Hypervisor utilisation time series';
@@ -0,0 +1,67 @@
+-- Support for multiple remote sources: the tables holding regional data get a
+-- source column, which is part of the primary key wherever the source's ids
+-- could clash with another source's. The existing data all came from the
+-- default source, so nothing needs to be backfilled.
+--
+-- These are online alters - the tables are rebuilt in place while the pollster
+-- and API carry on reading and writing them.
+
+alter table hypervisor
+        add column source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        drop primary key,
+        add primary key (id, availability_zone, host, source),
+        algorithm=inplace, lock=none;
+
+alter table flavour
+        add column source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        drop primary key,
+        add primary key (id, source),
+        algorithm=inplace, lock=none;
+
+alter table instance
+        add column source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        algorithm=inplace, lock=none;
+
+alter table volume
+        add column source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        algorithm=inplace, lock=none;
+
+alter table image
+        add column source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        algorithm=inplace, lock=none;
+
+alter table aggregate
+        add column source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        drop primary key,
+        add primary key (id, availability_zone, source),
+        algorithm=inplace, lock=none;
+
+alter table aggregate_host
+        add column source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        drop primary key,
+        add primary key (id, availability_zone, host, source),
+        algorithm=inplace, lock=none;
+
+alter table historical_usage
+        add column source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        drop primary key,
+        add primary key (day, source),
+        algorithm=inplace, lock=none;
+
+alter table historical_usage_project
+        add column source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        drop primary key,
+        add primary key (day, project_id, source),
+        algorithm=inplace, lock=none;
+
+alter table historical_usage_az
+        add column source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        drop primary key,
+        add primary key (day, availability_zone, source),
+        algorithm=inplace, lock=none;
+
+alter table hypervisor_utilisation
+        add column source varchar(64) not null default 'default' comment 'Remote source this record was extracted from' after host,
+        drop primary key,
+        add primary key (host, source, resolution, sample_time),
+        algorithm=inplace, lock=none;
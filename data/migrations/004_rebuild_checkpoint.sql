@@ -0,0 +1,11 @@
+-- Progress tracking for segmented rebuilds (--rebuild).
+
+create table if not exists rebuild_checkpoint (
+        table_name varchar(64) not null,
+        segment_start datetime not null comment "Segment covers records created from here",
+        segment_end datetime not null comment "Up to (but not including) here",
+        rebuild_start datetime not null comment "When the rebuild was planned",
+        completed datetime comment "Null until the segment is committed",
+        row_count int(11) comment "Records loaded for this segment",
+        primary key (table_name, segment_start)
+) comment 'Segmented rebuild progress';
@@ -0,0 +1,8 @@
+-- Indexes dropped for a bulk load (--bulk-load).
+
+create table if not exists deferred_index (
+        table_name varchar(64) not null,
+        index_name varchar(64) not null,
+        definition varchar(1024) not null comment "Index definition, as used in alter table ... add",
+        primary key (table_name, index_name)
+) comment 'Indexes deferred by a bulk load';
@@ -0,0 +1,7 @@
+-- The average in-memory size of the rows extracted for each table, used to
+-- estimate how much memory a full extraction will need (--memory-budget).
+-- It's filled in by the next update of each table.
+
+alter table metadata
+        add column row_width int(11) comment 'Average extracted row size in bytes',
+        algorithm=inplace, lock=none;
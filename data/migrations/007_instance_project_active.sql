@@ -0,0 +1,8 @@
+-- Project.has_instances is now read from the local instance table with
+-- select distinct project_id ... where active = 1, which this index turns into
+-- an index only scan. It replaces the plain project_id index, which it covers.
+
+alter table instance
+        add key instance_project_active_key (project_id, active),
+        drop key instance_project_id_key,
+        algorithm=inplace, lock=none;
@@ -0,0 +1,11 @@
+-- Version tokens (content hashes) of the upstream data each table was last
+-- updated from, so that work depending only on that data can be skipped when
+-- it hasn't changed.
+
+create table if not exists data_version (
+        consumer varchar(128) not null comment "Table (and source) that consumed the data",
+        name varchar(128) not null comment "Cached data name (and source)",
+        version char(40) not null comment "SHA1 of the data's content",
+        updated timestamp default current_timestamp on update current_timestamp,
+        primary key (consumer, name)
+) comment 'Upstream data versions consumed by each table';
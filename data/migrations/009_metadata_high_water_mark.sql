@@ -0,0 +1,8 @@
+-- The source's clock at the start of the last extraction of each table. The
+-- next last_update extraction starts from here (less --high-water-mark-margin)
+-- rather than going --last-update-window back from the local update time.
+-- It's filled in by the next update of each table.
+
+alter table metadata
+        add column high_water_mark datetime comment 'Source time the last extraction started',
+        algorithm=inplace, lock=none;
@@ -0,0 +1,20 @@
+-- A record of every table update - timings, row counts, peak memory, the
+-- update mode and any error - pruned after --history-retention-days and
+-- summarised by --history-report.
+
+create table if not exists run_history (
+        table_name varchar(64) not null,
+        started datetime not null comment "When the update started",
+        finished datetime comment "When it finished (or failed)",
+        mode varchar(16) comment "full, incremental or rebuild",
+        extract_time double comment "Seconds",
+        transform_time double comment "Seconds",
+        load_time double comment "Seconds",
+        export_time double comment "Seconds",
+        rows_extracted int(11) comment "Rows read from the source",
+        rows_written int(11) comment "Rows written locally",
+        peak_memory bigint comment "Peak resident memory in bytes",
+        error varchar(1024) comment "Null unless the update failed",
+        primary key (table_name, started),
+        key run_history_started (started)
+) comment 'History of table updates';
@@ -0,0 +1,12 @@
+-- The high water marks recorded so far were the source server's now(), which
+-- is in its session time zone rather than the naive UTC that nova writes, so
+-- they could be ahead of the change timestamps and skip changes. The mark is
+-- now the latest change time seen in the extracted rows; the old marks are
+-- cleared so the next update of each table goes --last-update-window back
+-- instead.
+
+alter table metadata
+        modify column high_water_mark datetime comment 'Latest source change time seen by the last extraction',
+        algorithm=inplace, lock=none;
+
+update metadata set high_water_mark = null;
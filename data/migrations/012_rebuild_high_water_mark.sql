@@ -0,0 +1,8 @@
+-- The latest source change when a rebuild was planned, which becomes the
+-- table's high water mark once the rebuild is done. It's recorded with the
+-- plan so that a resumed rebuild has it too - rebuilds planned before this
+-- migration keep the table's previous mark, which predates them.
+
+alter table rebuild_checkpoint
+        add column high_water_mark datetime comment "Latest source change when the rebuild was planned" after rebuild_start,
+        algorithm=inplace, lock=none;
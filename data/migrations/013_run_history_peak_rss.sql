@@ -0,0 +1,7 @@
+-- The peak memory recorded in the run history is the process's peak RSS,
+-- which never goes down, rather than the peak of each update - the column is
+-- renamed to say so.
+
+alter table run_history
+        change column peak_memory peak_rss bigint comment "Process peak resident memory in bytes when the update finished",
+        algorithm=inplace, lock=none;
@@ -16,10 +16,16 @@
 -- use reporting;
 
 -- metadata - note that this part of the design may change
+--
+-- When data is pulled from more than one remote source the entries for the
+-- additional sources are keyed on '<table>@<source>'. The tables holding
+-- regional data have a source column recording where each record came from.
 create table if not exists metadata (
         table_name varchar(64), -- this should be an enum, but it's not worth doing that until we know what all the tables are
         last_update timestamp default current_timestamp on update current_timestamp,
         row_count int(11) comment "count(*)",
+        row_width int(11) comment 'Average extracted row size in bytes',
+        high_water_mark datetime comment 'Latest source change time seen by the last extraction',
         primary key (table_name)
 ) comment 'Database metadata';
 
@@ -32,6 +38,69 @@ create table if not exists metadata (
 -- set the ts value to null, which will update the timestamp to the current
 -- value.
 
+-- The schema migrations (see data/migrations) that have been applied. A
+-- database created from this file has all of them applied.
+create table if not exists schema_version (
+        version int(11) not null comment 'Migration number',
+        name varchar(255) comment 'Migration name',
+        applied timestamp default current_timestamp comment 'When the migration was applied',
+        primary key (version)
+) comment 'Applied schema migrations';
+
+-- Progress of a segmented rebuild (--rebuild) - one row per segment, keyed on
+-- the same name as the metadata table. The rows are removed once the rebuild
+-- completes, so anything here is a rebuild that will be resumed.
+create table if not exists rebuild_checkpoint (
+        table_name varchar(64) not null,
+        segment_start datetime not null comment "Segment covers records created from here",
+        segment_end datetime not null comment "Up to (but not including) here",
+        rebuild_start datetime not null comment "When the rebuild was planned",
+        high_water_mark datetime comment "Latest source change when the rebuild was planned",
+        completed datetime comment "Null until the segment is committed",
+        row_count int(11) comment "Records loaded for this segment",
+        primary key (table_name, segment_start)
+) comment 'Segmented rebuild progress';
+
+-- Secondary indexes dropped for a bulk load (--bulk-load) - they're recorded
+-- here before they're dropped, and removed once they've been rebuilt.
+create table if not exists deferred_index (
+        table_name varchar(64) not null,
+        index_name varchar(64) not null,
+        definition varchar(1024) not null comment "Index definition, as used in alter table ... add",
+        primary key (table_name, index_name)
+) comment 'Indexes deferred by a bulk load';
+
+-- Version tokens (content hashes) of the upstream data each table was last
+-- updated from, so that work depending only on that data can be skipped when
+-- it hasn't changed.
+create table if not exists data_version (
+        consumer varchar(128) not null comment "Table (and source) that consumed the data",
+        name varchar(128) not null comment "Cached data name (and source)",
+        version char(40) not null comment "SHA1 of the data's content",
+        updated timestamp default current_timestamp on update current_timestamp,
+        primary key (consumer, name)
+) comment 'Upstream data versions consumed by each table';
+
+-- A record of every table update - timings, row counts, process peak RSS, the
+-- update mode and any error - pruned after --history-retention-days and
+-- summarised by --history-report.
+create table if not exists run_history (
+        table_name varchar(64) not null,
+        started datetime not null comment "When the update started",
+        finished datetime comment "When it finished (or failed)",
+        mode varchar(16) comment "full, incremental or rebuild",
+        extract_time double comment "Seconds",
+        transform_time double comment "Seconds",
+        load_time double comment "Seconds",
+        export_time double comment "Seconds",
+        rows_extracted int(11) comment "Rows read from the source",
+        rows_written int(11) comment "Rows written locally",
+        peak_rss bigint comment "Process peak resident memory in bytes when the update finished",
+        error varchar(1024) comment "Null unless the update failed",
+        primary key (table_name, started),
+        key run_history_started (started)
+) comment 'History of table updates';
+
 -- Physical machines hosting running hypervisor software, aka compute nodes.
 --
 -- no interaction with other tables at present.
@@ -46,7 +115,8 @@ create table if not exists hypervisor (
         local_storage int(11) comment 'Total local disk in GB',
         last_seen timestamp default current_timestamp on update current_timestamp comment 'last seen',
         active boolean default false comment 'Is this hypervisor active',
-        primary key (id, availability_zone, host),
+        source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        primary key (id, availability_zone, host, source),
         key hypervisor_hostname (hostname),
         key hypervisor_ip (ip_address),
         key hypervisor_last_seen (last_seen)
@@ -108,7 +178,8 @@ create table if not exists flavour (
         ephemeral int comment 'Size of ephemeral disk in GB',
         public boolean default false comment 'Is this flavour publically available',
         active boolean default false comment 'Is this flavour active',
-        primary key (id),
+        source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        primary key (id, source),
         key flavour_uuid_key (uuid)
 ) comment 'Types of virtual machine';
 
@@ -129,8 +200,9 @@ create table if not exists instance (
         hypervisor varchar(255) comment 'Hypervisor the instance is running on',
         availability_zone varchar(255) comment 'Availability zone the instance is running in',
         cell_name varchar(255) comment 'Cell that the instance is running in',
+        source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
         primary key (id),
-        key instance_project_id_key (project_id),
+        key instance_project_active_key (project_id, active),
         key instance_hypervisor_key (hypervisor),
         key instance_az_key (availability_zone)
 ) comment 'Virtual machine instances';
@@ -148,6 +220,7 @@ create table if not exists volume (
         instance_uuid varchar(36) comment 'Instance the volume is attached to',
         availability_zone varchar(255) comment 'Availability zone the volume exists in',
         active boolean default false comment 'Has this volume been deleted',
+        source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
         primary key (id),
         key volume_project_id_key (project_id),
         key volume_instance_uuid_key (instance_uuid),
@@ -165,6 +238,7 @@ create table if not exists image (
         created datetime comment 'Time image was created',
         deleted datetime comment 'Time image was deleted',
         active boolean default false comment 'Has this image been deleted',
+        source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
         primary key (id),
         key image_project_id_key (project_id)
 ) comment 'Operating system images';
@@ -184,7 +258,8 @@ create table if not exists aggregate (
         created datetime comment 'Time the aggregate was created',
         deleted datetime comment 'Time the aggregate was deleted',
         active boolean default false comment 'Is this aggregate active',
-        primary key (id, availability_zone)
+        source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        primary key (id, availability_zone, source)
 ) comment 'Aggregate definitions';
 
 -- no dependencies
@@ -200,7 +275,8 @@ create table if not exists aggregate_host (
         host varchar(255) comment 'Host name, same as first part of hypervisor.hostname',
         last_seen timestamp default current_timestamp on update current_timestamp comment 'last seen',
         active boolean default false comment 'Is this mapping active',
-        primary key (id, availability_zone, host),
+        source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        primary key (id, availability_zone, host, source),
         key aggregate_host_last_seen (last_seen)
 ) comment 'Mappings between aggregates and hosts';
 
@@ -220,9 +296,63 @@ create table if not exists historical_usage (
         vcpus int comment 'Allocated number of vCPUs',
         memory int comment 'Allocated memory in MB',
         local_storage int comment 'Allocated local storage (root+ephemeral) in GB',
-        primary key (day)
+        source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        primary key (day, source)
 ) comment 'Daily snapshots of resource usage';
 
+-- The same daily snapshots broken down by project and by availability zone,
+-- so that per-project and per-AZ usage history can be read with an index
+-- lookup rather than a scan of the instance table.
+--
+-- Instances running on hypervisors that aren't in any availability zone are
+-- counted against an empty availability_zone.
+create table if not exists historical_usage_project (
+        day date comment 'Day this usage record applies to',
+        project_id varchar(36) comment 'Project UUID',
+        vcpus int comment 'Allocated number of vCPUs',
+        memory int comment 'Allocated memory in MB',
+        local_storage int comment 'Allocated local storage (root+ephemeral) in GB',
+        source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        primary key (day, project_id, source),
+        key historical_usage_project_key (project_id, day)
+) comment 'Daily snapshots of resource usage by project';
+
+create table if not exists historical_usage_az (
+        day date comment 'Day this usage record applies to',
+        availability_zone varchar(255) comment 'Availability zone',
+        vcpus int comment 'Allocated number of vCPUs',
+        memory int comment 'Allocated memory in MB',
+        local_storage int comment 'Allocated local storage (root+ephemeral) in GB',
+        source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        primary key (day, availability_zone, source),
+        key historical_usage_az_key (availability_zone, day)
+) comment 'Daily snapshots of resource usage by availability zone';
+
+-- Hypervisor utilisation over time: the resources allocated to instances on
+-- each hypervisor, alongside its capacity and the usage nova reports.
+--
+-- This is a downsampled time series - raw samples (resolution 0) are kept for
+-- a short period, while the coarser resolutions hold the average of all the
+-- samples taken in each period and are kept for longer (or forever).
+create table if not exists hypervisor_utilisation (
+        host varchar(255) comment 'Host name, same as hypervisor.host',
+        source varchar(64) not null default 'default' comment 'Remote source this record was extracted from',
+        resolution int comment 'Sample period in seconds, 0 for raw samples',
+        sample_time datetime comment 'Start of the sample period',
+        samples int comment 'Number of raw samples averaged in this record',
+        cpus float comment 'Number of installed CPU cores',
+        vcpus_allocated float comment 'vCPUs allocated to live instances',
+        vcpus_used float comment 'vCPUs in use, as reported by nova',
+        memory float comment 'Total installed memory in MB',
+        memory_allocated float comment 'Memory allocated to live instances in MB',
+        memory_used float comment 'Memory in use in MB, as reported by nova',
+        local_storage float comment 'Total local disk in GB',
+        local_storage_allocated float comment 'Local disk allocated to live instances in GB',
+        local_storage_used float comment 'Local disk in use in GB, as reported by nova',
+        primary key (host, source, resolution, sample_time),
+        key hypervisor_utilisation_time_key (resolution, sample_time)
+) comment 'Hypervisor utilisation time series';
+
 -- A record of the allocations that were awarded
 create table if not exists allocation (
         id int(11) comment 'Allocation identifier',
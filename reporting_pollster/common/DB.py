@@ -6,51 +6,304 @@
 import logging
 import pymysql
 from pymysql.cursors import DictCursor
+from pymysql.err import MySQLError
 from reporting_pollster.common.config import Config
+from reporting_pollster.common.config import default_source
+from reporting_pollster.common.deadline import Deadline
+from reporting_pollster.common.deadline import DeadlineExceeded
+from reporting_pollster.common.replay import Replay
+from reporting_pollster.common.sqlite import SQLiteConnection
+from reporting_pollster.common.stats import estimate_size
+from reporting_pollster.common.stats import QueryStats
+from reporting_pollster.common.throttle import Throttle
+import threading
+import time
+
+
+class InstrumentedCursor(object):
+    """Wrap a database cursor, recording the latency, row count and payload
+    size of every query run through it.
+
+    Queries should be given a name so that they can be identified in the
+    statistics - unnamed queries are lumped together.
+
+    Queries against a remote source are subject to the Throttle, and to the
+    time budget of the entity running them (see common/deadline.py).
+    """
+
+    def __init__(self, cursor, target, source=None):
+        self.cursor = cursor
+        self.target = target
+        self.source = source or default_source
+        self.name = None
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def _threads_running(self):
+        try:
+            self.cursor.execute("show global status like 'Threads_running'")
+            row = self.cursor.fetchone()
+        except MySQLError as e:
+            logging.debug("Unable to read Threads_running (%s): %s",
+                          self.source, repr(e))
+            return None
+        if not row:
+            return None
+        if isinstance(row, dict):
+            return int(row['Value'])
+        return int(row[1])
+
+    def _throttle(self):
+        if self.target != 'remote' or not Throttle.enabled():
+            return
+        if Throttle.load_check_due(self.source):
+            Throttle.record_load(self.source, self._threads_running())
+        Throttle.wait(self.source)
+
+    def _record(self, elapsed, size=0):
+        QueryStats.record(self.target, self.name, elapsed,
+                          self.cursor.rowcount, size)
+        if self.target == 'remote':
+            Throttle.record(self.source, self.name, elapsed,
+                            self.cursor.rowcount)
+
+    def _watch(self, budget):
+        """Start a watchdog that cancels the query on the server if it runs
+        over its budget.
+        """
+        conn = getattr(self.cursor, 'connection', None)
+        if conn is None or not hasattr(conn, 'thread_id'):
+            return None
+        timer = threading.Timer(budget, DB.kill_remote_query,
+                                (self.source, conn.thread_id()))
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def execute(self, query, args=None, name=None):
+        self.name = name or 'unnamed'
+        self._throttle()
+        budget = None
+        if self.target == 'remote':
+            budget = Deadline.query_budget(self.source)
+        watchdog = None
+        if budget:
+            # the hint would change the recorded query text
+            if not Replay.recording() and not Replay.replaying():
+                query = Deadline.hint(query, budget)
+            watchdog = self._watch(budget)
+        start = time.time()
+        try:
+            res = self.cursor.execute(query, args)
+        except MySQLError as e:
+            if budget and e.args and e.args[0] in Deadline.interrupted_errors:
+                raise DeadlineExceeded(
+                    "Query %s (%s) cancelled after %.1fs" %
+                    (self.name, self.source, time.time() - start))
+            raise
+        finally:
+            if watchdog:
+                watchdog.cancel()
+        self._record(time.time() - start)
+        return res
+
+    def executemany(self, query, args, name=None):
+        self.name = name or 'unnamed'
+        self._throttle()
+        start = time.time()
+        res = self.cursor.executemany(query, args)
+        self._record(time.time() - start, estimate_size(args))
+        return res
+
+    def _fetch(self, method, *args):
+        start = time.time()
+        rows = method(*args)
+        if rows is None:
+            size = 0
+        elif isinstance(rows, dict):
+            size = estimate_size([rows])
+        else:
+            size = estimate_size(rows)
+        QueryStats.record_fetch(self.target, self.name, time.time() - start,
+                                size)
+        return rows
+
+    def fetchone(self):
+        return self._fetch(self.cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(self.cursor.fetchmany, size)
+
+    def fetchall(self):
+        return self._fetch(self.cursor.fetchall)
 
 
 class DB(object):
     """Wrap the database connections.
+
+    Remote connections are maintained per source. Since additional sources
+    are processed in their own threads the local connection is per thread -
+    pymysql connections can't be shared between threads.
+
+    The local store is normally MySQL, but may be an embedded SQLite database
+    ([local] backend = sqlite) - see common/sqlite.py.
     """
 
-    remote_creds = None
-    remote_conn = None
+    remote_creds = {}
+    remote_conns = {}
     local_creds = None
-    local_conn = None
+    local_conns = threading.local()
+    # additional remote connections, used for concurrent queries
+    remote_pools = {}
+    # the number of pooled connections handed out, per source
+    pool_in_use = {}
+    pool_lock = threading.Lock()
+    # statements run on every new local connection
+    local_session = []
+
+    @classmethod
+    def remote(cls, source=None):
+        source = source or default_source
+        if source not in cls.remote_conns:
+            cls.remote_creds[source] = Config.get_remote(source)
+            conn = pymysql.connect(cursorclass=DictCursor,
+                                   **cls.remote_creds[source])
+            logging.debug("Remote server version (%s): %s",
+                          source, conn.get_server_info())
+            cls.remote_conns[source] = conn
+        return cls.remote_conns[source]
+
+    @classmethod
+    def remote_cursor(cls, dictionary=True, source=None):
+        cursor = Replay.cursor(lambda: cls.remote(source).cursor(),
+                               source or default_source)
+        return InstrumentedCursor(cursor, 'remote', source)
+
+    @classmethod
+    def remote_connection(cls, source=None):
+        """Get a remote connection from the pool, for use by queries that run
+        concurrently with the main remote connection. It should be handed
+        back with release_remote_connection() when the caller is done with it.
+        """
+        source = source or default_source
+        # replayed queries don't need a connection
+        if Replay.replaying():
+            return None
+        with cls.pool_lock:
+            if cls.remote_pools.get(source):
+                cls.pool_in_use[source] = cls.pool_in_use.get(source, 0) + 1
+                return cls.remote_pools[source].pop()
+        conn = pymysql.connect(cursorclass=DictCursor,
+                               **Config.get_remote(source))
+        with cls.pool_lock:
+            cls.pool_in_use[source] = cls.pool_in_use.get(source, 0) + 1
+        return conn
 
     @classmethod
-    def remote(cls):
-        if not cls.remote_conn:
-            cls.remote_creds = Config.get_remote()
-            cls.remote_conn = pymysql.connect(cursorclass=DictCursor,
-                                              **cls.remote_creds)
-            logging.debug("Remote server version: %s",
-                          cls.remote_conn.get_server_info())
-        return cls.remote_conn
+    def release_remote_connection(cls, conn, source=None):
+        source = source or default_source
+        if conn is None:
+            return
+        with cls.pool_lock:
+            cls.pool_in_use[source] = cls.pool_in_use.get(source, 1) - 1
+            cls.remote_pools.setdefault(source, []).append(conn)
 
     @classmethod
-    def remote_cursor(cls, dictionary=True):
-        if not cls.remote_conn:
-            cls.remote()
-        return cls.remote().cursor()
+    def discard_remote_connection(cls, conn, source=None):
+        """Drop a pooled connection that's in an unknown state, rather than
+        handing it back.
+        """
+        source = source or default_source
+        if conn is None:
+            return
+        with cls.pool_lock:
+            cls.pool_in_use[source] = cls.pool_in_use.get(source, 1) - 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @classmethod
+    def kill_remote_query(cls, source, thread_id):
+        """Cancel the query running on a remote connection, from a side
+        connection.
+        """
+        logging.warning("Killing the query on remote connection %d (%s)",
+                        thread_id, source)
+        try:
+            conn = pymysql.connect(**Config.get_remote(source))
+            try:
+                conn.cursor().execute("kill query %d" % (thread_id))
+            finally:
+                conn.close()
+        except MySQLError as e:
+            logging.warning("Unable to kill the query on remote connection "
+                            "%d (%s): %s", thread_id, source, repr(e))
+
+    @classmethod
+    def pool_stats(cls):
+        """The state of the remote connections for each source.
+        """
+        with cls.pool_lock:
+            sources = (set(cls.remote_conns) | set(cls.remote_pools) |
+                       set(cls.pool_in_use))
+            return dict((source, {
+                'connected': source in cls.remote_conns,
+                'pool_idle': len(cls.remote_pools.get(source, [])),
+                'pool_in_use': cls.pool_in_use.get(source, 0),
+            }) for source in sources)
+
+    @classmethod
+    def pooled_cursor(cls, conn, source=None):
+        cursor = Replay.cursor(lambda: conn.cursor(),
+                               source or default_source)
+        return InstrumentedCursor(cursor, 'remote', source)
 
     @classmethod
     def local(cls):
-        if not cls.local_conn:
-            cls.local_creds = Config.get_local()
-            cls.local_conn = pymysql.connect(cursorclass=DictCursor,
-                                             **cls.local_creds)
+        conn = getattr(cls.local_conns, 'conn', None)
+        if not conn:
+            cls.local_creds = dict(Config.get_local())
+            if cls.local_creds.pop('backend', 'mysql') == 'sqlite':
+                conn = SQLiteConnection(cls.local_creds['path'],
+                                        cls.local_creds['schema'],
+                                        cls.local_creds.get('timeout', 60))
+            else:
+                conn = pymysql.connect(cursorclass=DictCursor,
+                                       **cls.local_creds)
             logging.debug("Local server version: %s",
-                          cls.local_conn.get_server_info())
-        return cls.local_conn
+                          conn.get_server_info())
+            for statement in cls.local_session:
+                conn.cursor().execute(statement)
+            cls.local_conns.conn = conn
+        return conn
+
+    @classmethod
+    def local_is_mysql(cls):
+        """Some things (EXPLAIN, bulk loading) only make sense with a MySQL
+        local store.
+        """
+        return Config.get_local_backend() == 'mysql'
 
     @classmethod
     def local_cursor(cls, dictionary=True):
-        if not cls.local_conn:
-            cls.local()
-        return cls.local().cursor()
+        return InstrumentedCursor(cls.local().cursor(), 'local')
 
     @classmethod
-    def invalidate(cls):
-        cls.local_conn = None
-        cls.remote_conn = None
+    def invalidate(cls, source=None):
+        """Drop the connections to the given source (and the local connection
+        for this thread), or all connections if no source is given.
+        """
+        cls.local_conns.conn = None
+        with cls.pool_lock:
+            if source:
+                cls.remote_conns.pop(source, None)
+                cls.remote_pools.pop(source, None)
+            else:
+                cls.remote_conns = {}
+                cls.remote_pools = {}
+                cls.pool_in_use = {}
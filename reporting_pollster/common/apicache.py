@@ -0,0 +1,156 @@
+#
+# Nova API response cache - the aggregate and hypervisor lists are fetched
+# concurrently at the start of each poll, and the last good response for each
+# call is kept (in memory, and with --api-cache-dir on disk, so it survives a
+# restart). When a call fails the last good response is used in its place, as
+# long as it's no older than --api-cache-max-age - one failed API call then
+# doesn't cost the whole run its hypervisor->AZ mapping.
+#
+# The entities fingerprint the responses (see Entity._fetch_api()) so
+# that they can skip work when nothing has changed since the last poll.
+#
+
+import gzip
+import logging
+import os
+import os.path
+import pickle
+import threading
+import time
+
+from reporting_pollster.common.replay import ReplayResource
+from reporting_pollster.common.replay import resource_info
+
+
+class ApiCache(object):
+    """Fetch and cache the results of Nova API list calls.
+    """
+
+    directory = None
+    # seconds - older cached responses aren't used
+    max_age = 3600
+    # (source, call) -> (thread, result holder) for prefetched calls
+    _pending = {}
+    # (source, call) -> {'fetched': time, 'data': [resource info]}
+    _last_good = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, directory=None, max_age=None):
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        cls.directory = directory
+        if max_age is not None:
+            cls.max_age = max_age
+        with cls._lock:
+            cls._pending = {}
+            cls._last_good = {}
+
+    @classmethod
+    def reset(cls):
+        """Drop any prefetched results that weren't used by the last poll.
+        """
+        with cls._lock:
+            cls._pending = {}
+
+    @staticmethod
+    def _call(client, call):
+        (manager, method) = call.split('.')
+        return getattr(getattr(client, manager), method)()
+
+    @classmethod
+    def _path(cls, source, call):
+        return os.path.join(cls.directory,
+                            "%s-%s.pickle.gz" % (source, call))
+
+    @classmethod
+    def _fetch_into(cls, holder, client_factory, call):
+        try:
+            holder['result'] = cls._call(client_factory(), call)
+        except Exception as e:
+            holder['error'] = e
+
+    @classmethod
+    def prefetch(cls, source, client_factory, calls):
+        """Start fetching the given calls concurrently, each in its own
+        thread - the results are picked up by fetch().
+        """
+        for call in calls:
+            holder = {}
+            t = threading.Thread(target=cls._fetch_into,
+                                 args=(holder, client_factory, call))
+            t.daemon = True
+            t.start()
+            with cls._lock:
+                cls._pending[(source, call)] = (t, holder)
+        if calls:
+            logging.debug("Prefetching %s (%s)", ", ".join(calls), source)
+
+    @classmethod
+    def _save(cls, source, call, entry):
+        with cls._lock:
+            cls._last_good[(source, call)] = entry
+        if not cls.directory:
+            return
+        path = cls._path(source, call)
+        try:
+            f = gzip.open(path + ".tmp", 'wb')
+            try:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError, pickle.PicklingError) as e:
+            logging.warning("Unable to cache %s (%s): %s", call, source, e)
+
+    @classmethod
+    def _load(cls, source, call):
+        with cls._lock:
+            entry = cls._last_good.get((source, call))
+        if entry or not cls.directory:
+            return entry
+        path = cls._path(source, call)
+        if not os.path.isfile(path):
+            return None
+        f = gzip.open(path, 'rb')
+        try:
+            return pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError) as e:
+            logging.warning("Unable to read cached %s (%s): %s", call,
+                            source, e)
+            return None
+        finally:
+            f.close()
+
+    @classmethod
+    def fetch(cls, source, call, client):
+        """Get the result of an API list call, using the prefetched result if
+        there is one. If the call fails the last good result is returned
+        instead, as long as it's recent enough.
+        """
+        with cls._lock:
+            pending = cls._pending.pop((source, call), None)
+        if pending:
+            (t, holder) = pending
+            t.join()
+        else:
+            holder = {}
+            cls._fetch_into(holder, lambda: client, call)
+        if 'error' not in holder:
+            result = holder['result']
+            cls._save(source, call,
+                      {'fetched': time.time(),
+                       'data': [resource_info(r) for r in result]})
+            return result
+        error = holder['error']
+        entry = cls._load(source, call)
+        if not entry:
+            raise error
+        age = time.time() - entry['fetched']
+        if age > cls.max_age:
+            logging.warning("Cached %s (%s) is too old to use (%ds)", call,
+                            source, age)
+            raise error
+        logging.warning("API call %s (%s) failed, using the response "
+                        "cached %ds ago: %s", call, source, age, repr(error))
+        return [ReplayResource(info) for info in entry['data']]
@@ -0,0 +1,184 @@
+#
+# Bulk load support - when the local tables are being rebuilt from scratch it's
+# much quicker to load them without their secondary indexes and build the
+# indexes once at the end than it is to maintain them row by row.
+#
+# The dropped indexes are recorded in the deferred_index table before they're
+# dropped, so that if the pollster dies part way through a bulk load they can
+# be put back the next time it starts.
+#
+
+import logging
+
+from pymysql.err import MySQLError
+
+from reporting_pollster.common.DB import DB
+
+
+class BulkLoad(object):
+    """Manage the local database during a bulk load.
+    """
+
+    queries = {
+        'show_index': "show index from {table}",
+        'record': (
+            "replace into deferred_index (table_name, index_name, definition) "
+            "values (%(table_name)s, %(index_name)s, %(definition)s)"
+        ),
+        'pending': (
+            "select table_name, index_name, definition from deferred_index "
+            "order by table_name, index_name"
+        ),
+        'done': "delete from deferred_index where table_name = %(table_name)s",
+        'get_durability': (
+            "select @@global.innodb_flush_log_at_trx_commit as value"
+        ),
+        'set_durability': (
+            "set global innodb_flush_log_at_trx_commit = %(value)s"
+        ),
+    }
+
+    # session settings for every local connection made during a bulk load
+    session = [
+        "set session unique_checks = 0",
+        "set session foreign_key_checks = 0",
+    ]
+    restore_session = [
+        "set session unique_checks = 1",
+        "set session foreign_key_checks = 1",
+    ]
+
+    active = False
+    saved_durability = None
+
+    @staticmethod
+    def index_definitions(rows):
+        """Turn the output of SHOW INDEX into a map of secondary index names
+        to the definitions needed to recreate them.
+        """
+        columns = {}
+        unique = {}
+        for row in rows:
+            name = row['Key_name']
+            if name == 'PRIMARY':
+                continue
+            column = "`%s`" % (row['Column_name'])
+            if row.get('Sub_part'):
+                column = "%s(%d)" % (column, row['Sub_part'])
+            columns.setdefault(name, []).append((row['Seq_in_index'], column))
+            unique[name] = not int(row['Non_unique'])
+        definitions = {}
+        for (name, cols) in columns.items():
+            definitions[name] = "%skey `%s` (%s)" % (
+                "unique " if unique[name] else "", name,
+                ", ".join(c for (seq, c) in sorted(cols)))
+        return definitions
+
+    @classmethod
+    def _execute(cls, qname, params=None, **fmt):
+        cursor = DB.local_cursor()
+        cursor.execute(cls.queries[qname].format(**fmt), params,
+                       name="bulk_load.%s" % (qname))
+        return cursor
+
+    @classmethod
+    def begin(cls, tables, relaxed_durability=False):
+        """Drop the secondary indexes from the given tables, and set up the
+        local connections for bulk loading.
+        """
+        if not DB.local_is_mysql():
+            logging.warning("Bulk loading is only supported with a MySQL "
+                            "local store - loading normally")
+            return
+        for table in tables:
+            cursor = cls._execute('show_index', table=table)
+            definitions = cls.index_definitions(cursor.fetchall())
+            if not definitions:
+                continue
+            for (name, definition) in sorted(definitions.items()):
+                cls._execute('record', {'table_name': table,
+                                        'index_name': name,
+                                        'definition': definition})
+            DB.local().commit()
+            logging.info("Dropping indexes from %s for bulk load: %s", table,
+                         ", ".join(sorted(definitions.keys())))
+            cursor = DB.local_cursor()
+            cursor.execute("alter table %s %s" % (
+                table, ", ".join("drop key `%s`" % (name)
+                                 for name in sorted(definitions.keys()))),
+                name="bulk_load.drop_index")
+        DB.local_session = list(cls.session)
+        for statement in cls.session:
+            DB.local_cursor().execute(statement, name="bulk_load.session")
+        cls.active = True
+        if relaxed_durability:
+            cls.relax_durability()
+
+    @classmethod
+    def relax_durability(cls):
+        """Only flush the InnoDB log once a second rather than at every commit.
+        This is a global setting, so it's restored as soon as we're done.
+        """
+        try:
+            value = cls._execute('get_durability').fetchone()['value']
+            cls._execute('set_durability', {'value': 2})
+        except MySQLError as e:
+            logging.warning("Unable to relax durability for bulk load: %s",
+                            repr(e))
+            return
+        cls.saved_durability = value
+        logging.info("Set innodb_flush_log_at_trx_commit = 2 (was %s)", value)
+
+    @classmethod
+    def finish(cls):
+        """Restore the session settings and durability, and rebuild the
+        deferred indexes.
+        """
+        if cls.saved_durability is not None:
+            cls._execute('set_durability', {'value': cls.saved_durability})
+            logging.info("Restored innodb_flush_log_at_trx_commit = %s",
+                         cls.saved_durability)
+            cls.saved_durability = None
+        if cls.active:
+            DB.local_session = []
+            for statement in cls.restore_session:
+                DB.local_cursor().execute(statement, name="bulk_load.session")
+            cls.active = False
+        if DB.local_is_mysql():
+            cls.rebuild_indexes()
+
+    @classmethod
+    def recover(cls):
+        """Put back any indexes left over from an interrupted bulk load.
+        """
+        if not DB.local_is_mysql():
+            return
+        try:
+            cls.rebuild_indexes()
+        except MySQLError as e:
+            logging.warning("Unable to check for deferred indexes: %s",
+                            repr(e))
+
+    @classmethod
+    def rebuild_indexes(cls):
+        """Recreate any indexes left in the deferred_index table - each table's
+        indexes are built with a single ALTER TABLE.
+        """
+        pending = {}
+        for row in cls._execute('pending').fetchall():
+            pending.setdefault(row['table_name'], []).append(row)
+        for (table, rows) in sorted(pending.items()):
+            # an earlier attempt may have got as far as building the indexes
+            cursor = cls._execute('show_index', table=table)
+            existing = cls.index_definitions(cursor.fetchall())
+            rows = [r for r in rows if r['index_name'] not in existing]
+            if rows:
+                logging.info("Building deferred indexes on %s: %s", table,
+                             ", ".join(r['index_name'] for r in rows))
+                cursor = DB.local_cursor()
+                cursor.execute("alter table %s %s" % (
+                    table, ", ".join("add %s" % (r['definition'])
+                                     for r in rows)),
+                    name="bulk_load.add_index")
+            cls._execute('done', {'table_name': table})
+            DB.local().commit()
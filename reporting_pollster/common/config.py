@@ -11,6 +11,7 @@ from keystoneauth1 import session
 from novaclient import client as nvclient
 
 from reporting_pollster.common import credentials
+from reporting_pollster.common.replay import Replay
 
 
 class ConfigError(Exception):
@@ -20,6 +21,11 @@ class ConfigError(Exception):
 
 config_file = "./reporting.conf"
 
+# the name used to tag data extracted from the source defined by the [remote]
+# and [nova] sections - additional sources are defined in [remote:<name>] and
+# [nova:<name>] sections
+default_source = 'default'
+
 # defaults for testing
 remote = {
     'user': 'reporting-test',
@@ -37,6 +43,13 @@ local = {
     'port': 3306,
 }
 
+# local store backends - sqlite needs a path to the database file, and the
+# schema file to generate its tables from
+local_backends = ['mysql', 'sqlite']
+sqlite_schema = (
+    "/usr/share/doc/python-reporting-pollster/reporting_schema_nectar.sql.gz"
+)
+
 # defaults for both testing and production
 dbs = {
     'keystone': 'keystone',
@@ -47,6 +60,12 @@ dbs = {
     'dashboard': 'dashboard',
 }
 
+# database mappings that may be left out of the [databases] section - the
+# nova_api database is only needed when extracting from nova cells v2
+optional_dbs = {
+    'nova_api': 'nova_api',
+}
+
 
 def sanitise_db_creds(creds):
     """Clean up certain values in the credentials to make sure that the DB driver
@@ -84,6 +103,10 @@ class Config(object):
     nova_api_version = '2'
     dbs = None
     config_file = None
+    remote_sources = {}
+    nova_sources = {}
+    throttle = {}
+    timeouts = {}
 
     def __init__(self):
         self.load_defaults()
@@ -98,6 +121,10 @@ class Config(object):
         cls.local = None
         cls.nova = None
         cls.dbs = None
+        cls.remote_sources = {}
+        cls.nova_sources = {}
+        cls.throttle = {}
+        cls.timeouts = {}
         # check environment first, override later
         cls.load_nova_environment()
 
@@ -118,6 +145,7 @@ class Config(object):
         for (name, value) in parser.items('local'):
             creds[name] = value
         cls.local = sanitise_db_creds(creds)
+        cls.check_local_backend(cls.local)
         if parser.has_section('nova'):
             creds = {}
             for (name, value) in parser.items('nova'):
@@ -128,14 +156,64 @@ class Config(object):
                 raise ConfigError("No Valid Nova Creds")
         if not parser.has_section('databases'):
             logging.info("No database mapping defined - using default")
-            cls.dbs = dbs
+            cls.dbs = dict(dbs, **optional_dbs)
         else:
-            cls.dbs = {}
+            cls.dbs = dict(optional_dbs)
             for (name, value) in parser.items('databases'):
                 cls.dbs[name] = value
-            if dbs.keys() != cls.dbs.keys():
+            if set(dbs.keys() + optional_dbs.keys()) != set(cls.dbs.keys()):
                 raise ConfigError("Invalid DB Mapping")
+        if parser.has_section('throttle'):
+            for (name, value) in parser.items('throttle'):
+                cls.throttle[name] = value
+        if parser.has_section('timeouts'):
+            for (name, value) in parser.items('timeouts'):
+                try:
+                    float(value)
+                except ValueError:
+                    raise ConfigError("Invalid timeout %s = %s" %
+                                      (name, value))
+                cls.timeouts[name] = value
         verify_nova_creds(cls.nova_api_version, cls.nova)
+        cls.load_sources(parser)
+
+    @classmethod
+    def check_local_backend(cls, creds):
+        backend = creds.get('backend', 'mysql')
+        if backend not in local_backends:
+            raise ConfigError("Unknown local backend %s" % (backend))
+        if backend == 'sqlite':
+            if 'path' not in creds:
+                raise ConfigError("The sqlite local backend needs a path")
+            creds.setdefault('schema', sqlite_schema)
+
+    @classmethod
+    def load_sources(cls, parser):
+        """Load any additional remote sources - each [remote:<name>] section
+        defines the database for a source, and the matching [nova:<name>]
+        section overrides the default nova credentials for it (typically just
+        the region_name).
+        """
+        for section in parser.sections():
+            if not section.startswith('remote:'):
+                continue
+            name = section.split(':', 1)[1]
+            if not name or name == default_source:
+                raise ConfigError("Invalid remote source name %s" % (name))
+            creds = {}
+            for (key, value) in parser.items(section):
+                creds[key] = value
+            cls.remote_sources[name] = sanitise_db_creds(creds)
+            creds = dict(cls.nova)
+            if parser.has_section('nova:' + name):
+                for (key, value) in parser.items('nova:' + name):
+                    creds[key] = value
+            creds.pop('version', None)
+            cls.nova_sources[name] = creds
+            verify_nova_creds(cls.nova_api_version, creds)
+        if cls.remote_sources:
+            logging.info("Additional remote sources: %s",
+                         ", ".join(sorted(cls.remote_sources.keys())))
 
     @classmethod
     def load_config(cls, filename):
@@ -151,7 +229,9 @@ class Config(object):
             logging.debug("Loading in-build default configuration")
             cls.remote = sanitise_db_creds(remote)
             cls.local = sanitise_db_creds(local)
-            cls.dbs = dbs
+            cls.dbs = dict(dbs, **optional_dbs)
+            cls.remote_sources = {}
+            cls.nova_sources = {}
             cls.load_nova_environment()
         verify_nova_creds(cls.nova_api_version, cls.nova)
 
@@ -174,9 +254,19 @@ class Config(object):
             logging.info("Loading nova credentials from environment failed")
 
     @classmethod
-    def get_remote(cls):
+    def get_sources(cls):
+        """List the names of all the remote sources, default source first.
+        """
         if not cls.remote:
             cls.load_defaults()
+        return [default_source] + sorted(cls.remote_sources.keys())
+
+    @classmethod
+    def get_remote(cls, source=None):
+        if not cls.remote:
+            cls.load_defaults()
+        if source and source != default_source:
+            return cls.remote_sources[source]
         return cls.remote
 
     @classmethod
@@ -186,9 +276,15 @@ class Config(object):
         return cls.local
 
     @classmethod
-    def get_nova(cls):
+    def get_local_backend(cls):
+        return cls.get_local().get('backend', 'mysql')
+
+    @classmethod
+    def get_nova(cls, source=None):
         if not cls.nova:
             cls.load_defaults()
+        if source and source != default_source:
+            return cls.nova_sources[source]
         return cls.nova
 
     @classmethod
@@ -207,12 +303,30 @@ class Config(object):
         return cls.dbs
 
     @classmethod
-    def get_nova_client(cls, nova_version=None, creds=None):
+    def get_throttle(cls):
+        return cls.throttle
+
+    @classmethod
+    def get_timeouts(cls):
+        return cls.timeouts
+
+    @classmethod
+    def get_nova_client(cls, nova_version=None, creds=None, source=None):
+        return Replay.nova_client(
+            lambda: cls._get_nova_client(nova_version, creds, source),
+            source or default_source)
+
+    @classmethod
+    def _get_nova_client(cls, nova_version=None, creds=None, source=None):
         if not nova_version:
             nova_version = cls.get_nova_api_version()
         if not creds:
-            creds = cls.get_nova()
+            creds = cls.get_nova(source)
+        # the region isn't part of the authentication data
+        creds = dict(creds)
+        region_name = creds.pop('region_name', None)
         loader = loading.get_plugin_loader("password")
         auth = loader.load_from_options(**creds)
         sess = session.Session(auth=auth)
-        return nvclient.Client(nova_version, session=sess)
+        return nvclient.Client(nova_version, session=sess,
+                               region_name=region_name)
@@ -0,0 +1,132 @@
+#
+# Time budgets for the remote extraction - so that one runaway query (say the
+# project quota join while the nova database is having a bad day) can't hold
+# up the whole polling loop.
+#
+# Each entity gets a deadline when it starts processing, and every remote
+# query it runs gets a budget: the per-query timeout, cut down to whatever is
+# left before the entity's deadline. Queries that run over their budget are
+# cancelled on the server - selects carry a MAX_EXECUTION_TIME hint (MySQL
+# 5.7.8 and later, and just a comment to anything else), and a watchdog on
+# the pollster side runs KILL QUERY from a side connection for everything
+# else. The entity then fails with DeadlineExceeded, and the poll moves on to
+# the next table.
+#
+# The deadlines are tracked per source rather than per thread, so they apply
+# to the concurrent queries an entity runs on pooled connections too.
+#
+
+from datetime import datetime
+from datetime import timedelta
+import logging
+import re
+import threading
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, msg):
+        super(DeadlineExceeded, self).__init__(msg)
+        self.msg = msg
+
+
+select_re = re.compile(r"^\s*select\b", re.I)
+
+
+class Deadline(object):
+    """Track the time budgets of the entities being processed.
+
+    Timeouts are configured from the [timeouts] section of the config file
+    (and the --entity-timeout and --query-timeout options): entity and query
+    set the defaults, and any other entry sets the entity timeout for the
+    table it's named after. Both are disabled (unlimited) by default.
+    """
+
+    entity_timeout = None
+    query_timeout = None
+    # table -> entity timeout
+    table_timeouts = {}
+    # mysql errors for queries interrupted by KILL QUERY and by the
+    # MAX_EXECUTION_TIME hint
+    interrupted_errors = (1317, 3024)
+    # source -> (table, deadline)
+    _deadlines = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, settings, entity_timeout=None, query_timeout=None):
+        cls.entity_timeout = None
+        cls.query_timeout = None
+        cls.table_timeouts = {}
+        for (name, value) in settings.items():
+            if name == 'entity':
+                cls.entity_timeout = float(value)
+            elif name == 'query':
+                cls.query_timeout = float(value)
+            else:
+                cls.table_timeouts[name] = float(value)
+        if entity_timeout:
+            cls.entity_timeout = float(entity_timeout)
+        if query_timeout:
+            cls.query_timeout = float(query_timeout)
+        with cls._lock:
+            cls._deadlines = {}
+        if cls.entity_timeout or cls.query_timeout or cls.table_timeouts:
+            logging.info("Deadlines: entity %s, query %s%s",
+                         cls.entity_timeout or "unlimited",
+                         cls.query_timeout or "unlimited",
+                         "".join(", %s %s" % (t, v) for (t, v) in
+                                 sorted(cls.table_timeouts.items())))
+
+    @classmethod
+    def start(cls, source, table):
+        timeout = cls.table_timeouts.get(table, cls.entity_timeout)
+        with cls._lock:
+            if timeout:
+                cls._deadlines[source] = (
+                    table, datetime.now() + timedelta(seconds=timeout))
+            else:
+                cls._deadlines.pop(source, None)
+
+    @classmethod
+    def finish(cls, source):
+        with cls._lock:
+            cls._deadlines.pop(source, None)
+
+    @classmethod
+    def remaining(cls, source):
+        """The seconds left before the source's current entity runs out of
+        time, or None if it has no deadline.
+        """
+        with cls._lock:
+            deadline = cls._deadlines.get(source)
+        if not deadline:
+            return None
+        return (deadline[1] - datetime.now()).total_seconds()
+
+    @classmethod
+    def check(cls, source):
+        remaining = cls.remaining(source)
+        if remaining is not None and remaining <= 0:
+            with cls._lock:
+                table = cls._deadlines.get(source, (None, None))[0]
+            raise DeadlineExceeded("Processing of %s (%s) ran out of time" %
+                                   (table, source))
+
+    @classmethod
+    def query_budget(cls, source):
+        """The time a remote query may run for, or None if it's unlimited.
+        Raises DeadlineExceeded if there's no time left.
+        """
+        cls.check(source)
+        budgets = [b for b in (cls.query_timeout, cls.remaining(source))
+                   if b is not None]
+        if not budgets:
+            return None
+        return min(budgets)
+
+    @staticmethod
+    def hint(query, budget):
+        """Add a MAX_EXECUTION_TIME hint to a select.
+        """
+        return select_re.sub("select /*+ MAX_EXECUTION_TIME(%d) */" %
+                             (max(1, int(budget * 1000))), query, count=1)
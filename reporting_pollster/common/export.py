@@ -0,0 +1,134 @@
+#
+# Columnar export - write the data refreshed by each run out as Parquet or
+# Arrow IPC files, so that analytic workloads can be run against the files
+# rather than the live reporting database.
+#
+# Each table gets its own directory, partitioned by day:
+#
+#   <export dir>/<table>/day=YYYY-MM-DD/<table>-<run time>-<source>.<format>
+#
+# Tables with a natural day column (historical_usage) are partitioned on it.
+# Everything else is partitioned on the day of the run that refreshed it, so
+# each file holds the records that changed in that run - since exports follow
+# the same last_update watermark as the updates, a record that changes again
+# later turns up again in a later file, and the latest file wins.
+#
+# The historical_usage days since the last update are re-exported by every
+# run (today's totals keep changing until the day is over), so a day
+# partition can hold several files for the same source: readers should take
+# each day's record from the file with the latest run time.
+#
+# A rebuild writes a file per segment, named
+# <table>-<run time>-<source>-<part>.<format>, and exports the rebuilt
+# historical_usage in full once it's finished.
+#
+# pyarrow is an optional dependency, only needed when exporting.
+#
+
+from datetime import datetime
+import logging
+import os
+import os.path
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class ExportError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class Export(object):
+    """Write sets of records out as columnar files.
+    """
+
+    formats = {
+        'parquet': 'parquet',
+        'arrow': 'arrow',
+    }
+
+    def __init__(self, export_dir, export_format='parquet',
+                 compression='snappy'):
+        if export_format not in self.formats:
+            raise ExportError("Unknown export format %s" % (export_format))
+        self.export_dir = export_dir
+        self.export_format = export_format
+        self.compression = compression
+
+    @staticmethod
+    def available():
+        return pyarrow is not None
+
+    @staticmethod
+    def partition(rows, day_column=None, default_day=None):
+        """Split the rows into per-day partitions, keyed on the day's ISO date
+        string.
+        """
+        partitions = {}
+        default_key = (default_day or datetime.now()).strftime("%Y-%m-%d")
+        for row in rows:
+            key = default_key
+            if day_column and row.get(day_column):
+                key = row[day_column].strftime("%Y-%m-%d")
+            partitions.setdefault(key, []).append(row)
+        return partitions
+
+    def path(self, table, day, run_time, source, part=None):
+        name = "%s-%s-%s" % (table, run_time.strftime("%Y%m%dT%H%M%S"),
+                             source)
+        if part:
+            name = "%s-%s" % (name, part)
+        filename = "%s.%s" % (name, self.formats[self.export_format])
+        return os.path.join(self.export_dir, table, "day=%s" % (day),
+                            filename)
+
+    @staticmethod
+    def to_table(rows):
+        columns = sorted(rows[0].keys())
+        arrays = [pyarrow.array([row.get(c) for row in rows])
+                  for c in columns]
+        return pyarrow.Table.from_arrays(arrays, names=columns)
+
+    def _write_file(self, path, rows):
+        table = self.to_table(rows)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write to a temporary file and rename it, so that readers never see
+        # a partial file
+        tmp = path + ".tmp"
+        if self.export_format == 'parquet':
+            pyarrow.parquet.write_table(table, tmp,
+                                        compression=self.compression)
+        else:
+            writer = pyarrow.RecordBatchFileWriter(tmp, table.schema)
+            try:
+                writer.write_table(table)
+            finally:
+                writer.close()
+        os.rename(tmp, path)
+
+    def write(self, table, rows, day_column=None, source='default',
+              run_time=None, part=None):
+        """Export a set of records for the given table, returning the list of
+        files written. Exports of several parts of the same run are told
+        apart by their part name.
+        """
+        if not rows:
+            return []
+        if not self.available():
+            raise ExportError("Exporting requires pyarrow")
+        run_time = run_time or datetime.now()
+        paths = []
+        partitions = self.partition(rows, day_column, run_time)
+        for (day, day_rows) in sorted(partitions.items()):
+            path = self.path(table, day, run_time, source, part)
+            self._write_file(path, day_rows)
+            paths.append(path)
+        logging.info("Exported %d %s records to %d %s files", len(rows),
+                     table, len(paths), self.export_format)
+        return paths
@@ -0,0 +1,141 @@
+#
+# Run history - every table processed by a poll leaves a record in the local
+# run_history table: when it ran, how long each stage took, how many rows it
+# read and wrote, the process peak RSS, the update mode and any error. The
+# records are pruned after a retention period, and summarised by
+# --history-report to show the trends over days or weeks.
+#
+
+from datetime import datetime
+from datetime import timedelta
+import logging
+
+from reporting_pollster.common.DB import DB
+
+
+def seconds(value):
+    if value is None:
+        return "-"
+    return "%.1fs" % (value)
+
+
+class RunHistory(object):
+    """Report on and prune the history of table updates - the records are
+    saved by Entity.process().
+    """
+
+    queries = {
+        'record': (
+            "replace into run_history (table_name, started, finished, mode, "
+            "extract_time, transform_time, load_time, export_time, "
+            "rows_extracted, rows_written, peak_rss, error) "
+            "values (%(table_name)s, %(started)s, %(finished)s, %(mode)s, "
+            "%(extract_time)s, %(transform_time)s, %(load_time)s, "
+            "%(export_time)s, %(rows_extracted)s, %(rows_written)s, "
+            "%(peak_rss)s, %(error)s)"
+        ),
+        'prune': "delete from run_history where started < %(before)s",
+        'last_duration': (
+            "select extract_time + transform_time + load_time + export_time "
+            "as duration from run_history "
+            "where table_name = %(table_name)s and error is null "
+            "order by started desc limit 1"
+        ),
+        'history': (
+            "select table_name, started, finished, mode, extract_time, "
+            "transform_time, load_time, export_time, rows_extracted, "
+            "rows_written, peak_rss, error from run_history "
+            "where started >= %(since)s order by table_name, started"
+        ),
+    }
+
+    # a table's recent runs are flagged as a regression when they take this
+    # much longer than the runs before them
+    regression_threshold = 1.5
+    # how far back the "recent" runs go
+    recent = timedelta(days=1)
+
+    @classmethod
+    def prune(cls, retention_days):
+        if not retention_days:
+            return
+        before = datetime.now() - timedelta(days=retention_days)
+        cursor = DB.local_cursor()
+        cursor.execute(cls.queries['prune'], {'before': before},
+                       name="run_history.prune")
+        DB.local().commit()
+        if cursor.rowcount > 0:
+            logging.debug("Pruned %d run history records", cursor.rowcount)
+
+    @staticmethod
+    def duration(run):
+        return (run['extract_time'] + run['transform_time'] +
+                run['load_time'] + run['export_time'])
+
+    @classmethod
+    def summarise(cls, runs, now=None):
+        """Summarise a table's runs (in start order), comparing the recent
+        runs with the ones before them.
+        """
+        now = now or datetime.now()
+        good = [r for r in runs if not r['error']]
+        recent = [r for r in good if r['started'] >= now - cls.recent]
+        earlier = [r for r in good if r['started'] < now - cls.recent]
+
+        def mean(values):
+            values = list(values)
+            if not values:
+                return None
+            return sum(values) / float(len(values))
+
+        summary = {
+            'runs': len(runs),
+            'errors': len(runs) - len(good),
+            'full': len([r for r in runs if r['mode'] != 'incremental']),
+            'duration': mean(cls.duration(r) for r in good),
+            'recent_duration': mean(cls.duration(r) for r in recent),
+            'earlier_duration': mean(cls.duration(r) for r in earlier),
+            'rows_written': mean(r['rows_written'] for r in good),
+            'peak_rss': max([r['peak_rss'] for r in runs] or [0]),
+            'last_error': None,
+            'regression': False,
+        }
+        if summary['errors']:
+            summary['last_error'] = [r for r in runs if r['error']][-1]
+        if summary['recent_duration'] and summary['earlier_duration']:
+            summary['regression'] = (summary['recent_duration'] >
+                                     summary['earlier_duration'] *
+                                     cls.regression_threshold)
+        return summary
+
+    @classmethod
+    def report(cls, days, now=None):
+        """Report on the table updates over the last number of days.
+        """
+        now = now or datetime.now()
+        cursor = DB.local_cursor()
+        cursor.execute(cls.queries['history'],
+                       {'since': now - timedelta(days=days)},
+                       name="run_history.history")
+        tables = {}
+        for run in cursor.fetchall():
+            tables.setdefault(run['table_name'], []).append(run)
+        lines = ["Run history for the last %d days:" % (days)]
+        if not tables:
+            lines.append("\tno runs recorded")
+        for (table, runs) in sorted(tables.items()):
+            s = cls.summarise(runs, now)
+            lines.append(
+                "\t%s: runs=%d full=%d errors=%d mean=%s last day=%s "
+                "before=%s rows written=%.0f peak RSS=%.1fMB%s" % (
+                    table, s['runs'], s['full'], s['errors'],
+                    seconds(s['duration']), seconds(s['recent_duration']),
+                    seconds(s['earlier_duration']), s['rows_written'] or 0,
+                    (s['peak_rss'] or 0) / 1048576.0,
+                    " REGRESSION" if s['regression'] else "")
+            )
+            if s['last_error']:
+                lines.append("\t\tlast error at %s: %s" % (
+                    s['last_error']['started'].isoformat(),
+                    s['last_error']['error']))
+        return "\n".join(lines)
@@ -0,0 +1,325 @@
+#
+# Record and replay of the remote extraction - with --record every remote query
+# result and Nova API response from a run is captured to local files, and with
+# --replay those files are fed back to the entities in place of the remote
+# databases and the Nova API. This allows transform and load work (profiling,
+# regression testing) to be done offline against real data.
+#
+# Results are keyed on the source and the query text (or the API manager and
+# method), and replayed in the order they were recorded (with the last result
+# repeated once they run out, so a recording can be polled against). The query
+# parameters are saved alongside the results but aren't used for matching,
+# since they include timestamps that differ from run to run.
+#
+# At the end of every polling iteration the results recorded by that poll are
+# saved to a directory of their own (poll0001, poll0002 and so on), with a
+# gzipped pickle file for each source, and then dropped from memory - so
+# recording a long running poller doesn't hold on to every result it has
+# ever seen. A replay loads the polls in order, so the results are replayed
+# poll by poll.
+#
+
+import glob
+import gzip
+import logging
+import os
+import os.path
+import pickle
+import threading
+
+
+class ReplayError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class BufferedCursor(object):
+    """The fetch side of a (buffered) cursor, serving rows from a list.
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.rowcount = -1
+
+    def fetchone(self):
+        if not self.rows:
+            return None
+        return self.rows.pop(0)
+
+    def fetchmany(self, size=None):
+        size = size or 1
+        (rows, self.rows) = (self.rows[:size], self.rows[size:])
+        return rows
+
+    def fetchall(self):
+        (rows, self.rows) = (self.rows, [])
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+
+class RecordingCursor(BufferedCursor):
+    """Wrap a remote cursor, recording the results of every query.
+    """
+
+    def __init__(self, cursor, source):
+        super(RecordingCursor, self).__init__()
+        self.cursor = cursor
+        self.source = source
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def execute(self, query, args=None):
+        res = self.cursor.execute(query, args)
+        self.rows = list(self.cursor.fetchall() or [])
+        self.rowcount = self.cursor.rowcount
+        Replay.record_query(self.source, query, args, list(self.rows))
+        return res
+
+
+class ReplayCursor(BufferedCursor):
+    """Stand in for a remote cursor, serving the recorded results.
+    """
+
+    def __init__(self, source):
+        super(ReplayCursor, self).__init__()
+        self.source = source
+
+    def execute(self, query, args=None):
+        self.rows = list(Replay.replay_query(self.source, query))
+        self.rowcount = len(self.rows)
+        return self.rowcount
+
+    def close(self):
+        pass
+
+
+class ReplayResource(object):
+    """Stand in for a novaclient resource - the recorded fields are exposed as
+    attributes.
+    """
+
+    def __init__(self, info):
+        self._info = info
+        self.__dict__.update(info)
+
+    def to_dict(self):
+        return dict(self._info)
+
+
+def resource_info(resource):
+    if hasattr(resource, 'to_dict'):
+        return resource.to_dict()
+    return resource
+
+
+class RecordingManager(object):
+    def __init__(self, manager, name, source):
+        self.manager = manager
+        self.name = name
+        self.source = source
+
+    def __getattr__(self, attr):
+        method = getattr(self.manager, attr)
+
+        def call(*args, **kwargs):
+            result = method(*args, **kwargs)
+            if isinstance(result, list):
+                info = [resource_info(r) for r in result]
+            else:
+                info = resource_info(result)
+            Replay.record_api(self.source, "%s.%s" % (self.name, attr), info)
+            return result
+        return call
+
+
+class RecordingNovaClient(object):
+    """Wrap a nova client, recording the results of every API call made
+    through its managers (client.hypervisors.list() and the like).
+    """
+
+    def __init__(self, client, source):
+        self.client = client
+        self.source = source
+
+    def __getattr__(self, attr):
+        return RecordingManager(getattr(self.client, attr), attr, self.source)
+
+
+class ReplayManager(object):
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+
+    def __getattr__(self, attr):
+        def call(*args, **kwargs):
+            info = Replay.replay_api(self.source, "%s.%s" % (self.name, attr))
+            if isinstance(info, list):
+                return [ReplayResource(i) for i in info]
+            return ReplayResource(info)
+        return call
+
+
+class ReplayNovaClient(object):
+    def __init__(self, source):
+        self.source = source
+
+    def __getattr__(self, attr):
+        return ReplayManager(attr, self.source)
+
+
+class Replay(object):
+    """Manage the recording and replaying of remote results.
+    """
+
+    mode = None
+    directory = None
+    # source -> {'queries': {query: [(params, rows)]},
+    #            'api': {call: [result]}}
+    _data = {}
+    # the number of polls saved by this recording
+    _polls = 0
+    _lock = threading.Lock()
+
+    @classmethod
+    def recording(cls):
+        return cls.mode == 'record'
+
+    @classmethod
+    def replaying(cls):
+        return cls.mode == 'replay'
+
+    @classmethod
+    def _source_data(cls, source):
+        # call with the lock held
+        return cls._data.setdefault(source, {'queries': {}, 'api': {}})
+
+    @staticmethod
+    def _path(directory, source):
+        return os.path.join(directory, "%s.pickle.gz" % (source))
+
+    @classmethod
+    def start_recording(cls, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        cls.mode = 'record'
+        cls.directory = directory
+        cls._data = {}
+        cls._polls = 0
+        logging.info("Recording remote results to %s", directory)
+
+    @classmethod
+    def start_replay(cls, directory):
+        # recordings made before the polls were saved separately have their
+        # files at the top level
+        paths = (sorted(glob.glob(os.path.join(directory, "*.pickle.gz"))) +
+                 sorted(glob.glob(os.path.join(directory, "poll*",
+                                               "*.pickle.gz"))))
+        if not paths:
+            raise ReplayError("No recordings found in %s" % (directory))
+        cls._data = {}
+        for path in paths:
+            source = os.path.basename(path)[:-len(".pickle.gz")]
+            f = gzip.open(path, 'rb')
+            try:
+                data = pickle.load(f)
+            finally:
+                f.close()
+            merged = cls._source_data(source)
+            for kind in ('queries', 'api'):
+                for (key, results) in data[kind].items():
+                    merged[kind].setdefault(key, []).extend(results)
+        cls.mode = 'replay'
+        cls.directory = directory
+        logging.info("Replaying remote results from %s (sources: %s)",
+                     directory, ", ".join(sorted(cls._data.keys())))
+
+    @classmethod
+    def stop(cls):
+        cls.mode = None
+        cls.directory = None
+        cls._data = {}
+        cls._polls = 0
+
+    @classmethod
+    def save(cls):
+        """Write out everything recorded by this poll, and drop it.
+        """
+        if not cls.recording():
+            return
+        with cls._lock:
+            cls._polls += 1
+            directory = os.path.join(cls.directory, "poll%04d" % (cls._polls))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            for (source, data) in cls._data.items():
+                path = cls._path(directory, source)
+                # write to a temporary file and rename it, so that an
+                # interrupted save doesn't lose the previous recording
+                f = gzip.open(path + ".tmp", 'wb')
+                try:
+                    pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+                finally:
+                    f.close()
+                os.rename(path + ".tmp", path)
+                logging.debug("Saved %d queries and %d API calls for %s to "
+                              "%s", len(data['queries']), len(data['api']),
+                              source, path)
+            cls._data = {}
+
+    @classmethod
+    def record_query(cls, source, query, params, rows):
+        with cls._lock:
+            queries = cls._source_data(source)['queries']
+            queries.setdefault(query, []).append((params, rows))
+
+    @classmethod
+    def replay_query(cls, source, query):
+        with cls._lock:
+            results = cls._source_data(source)['queries'].get(query)
+            if not results:
+                raise ReplayError("No recorded results left for query on "
+                                  "%s: %s" % (source, query))
+            if len(results) > 1:
+                return results.pop(0)[1]
+            return results[0][1]
+
+    @classmethod
+    def record_api(cls, source, call, result):
+        with cls._lock:
+            api = cls._source_data(source)['api']
+            api.setdefault(call, []).append(result)
+
+    @classmethod
+    def replay_api(cls, source, call):
+        with cls._lock:
+            results = cls._source_data(source)['api'].get(call)
+            if not results:
+                raise ReplayError("No recorded results left for API call %s "
+                                  "on %s" % (call, source))
+            if len(results) > 1:
+                return results.pop(0)
+            return results[0]
+
+    @classmethod
+    def cursor(cls, cursor_factory, source):
+        """Get a remote cursor for the source - cursor_factory is only called
+        when we need a real cursor.
+        """
+        if cls.replaying():
+            return ReplayCursor(source)
+        cursor = cursor_factory()
+        if cls.recording():
+            return RecordingCursor(cursor, source)
+        return cursor
+
+    @classmethod
+    def nova_client(cls, client_factory, source):
+        if cls.replaying():
+            return ReplayNovaClient(source)
+        client = client_factory()
+        if cls.recording():
+            return RecordingNovaClient(client, source)
+        return client
@@ -0,0 +1,339 @@
+#
+# Embedded SQLite backend for the local store - with [local] backend = sqlite
+# the local tables live in a file on the pollster host, so local writes are
+# in-process calls and no database server is needed (handy for benchmarks and
+# tests).
+#
+# The entity code is written against MySQL, so the connection wrapper here
+# translates the local queries on the way through:
+#
+#  - pymysql style %(name)s and %s parameters become :name and ? parameters
+#  - insert ... on duplicate key update becomes an upsert on the table's
+#    primary key, with values(column) mapped to excluded.column
+#
+# replace into works as it is. The schema is generated from the MySQL schema
+# file (see translate_schema()), including triggers standing in for the
+# timestamp columns' on update current_timestamp behaviour.
+#
+# Only the local store can be SQLite - the remote sources are always MySQL.
+#
+
+from datetime import datetime
+from decimal import Decimal
+import gzip
+import logging
+import os.path
+import re
+import sqlite3
+
+
+class SQLiteError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+def convert_datetime(value):
+    """Convert a stored datetime back into a datetime object - values may have
+    been stored with or without the time and microseconds.
+    """
+    value = value.replace('T', ' ')
+    for fmt in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return value
+
+
+def convert_date(value):
+    value = convert_datetime(value)
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+
+sqlite3.register_converter('date', convert_date)
+sqlite3.register_converter('datetime', convert_datetime)
+sqlite3.register_converter('timestamp', convert_datetime)
+# MySQL hands back decimals for sums and the like, which sqlite3 doesn't know
+# how to store
+sqlite3.register_adapter(Decimal, str)
+
+# MySQL's current_timestamp is in the session's time zone (local time, since
+# the pollster works in naive local datetimes) - SQLite's is UTC
+now = "datetime('now', 'localtime')"
+
+comment_re = re.compile(r"--[^\n]*")
+column_comment_re = re.compile(
+    r"\s+comment\s+('(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\")", re.I)
+on_update_re = re.compile(r"\s+on\s+update\s+current_timestamp", re.I)
+default_now_re = re.compile(r"default\s+current_timestamp", re.I)
+default_bool_re = re.compile(r"default\s+(true|false)", re.I)
+create_re = re.compile(r"create\s+table\s+(?:if\s+not\s+exists\s+)?(\S+)",
+                       re.I)
+key_re = re.compile(r"(unique\s+)?(?:key|index)\s+(\S+)\s*\((.*)\)$",
+                    re.I | re.S)
+primary_re = re.compile(r"primary\s+key\s*\((.*)\)$", re.I | re.S)
+
+param_re = re.compile(r"%\((\w+)\)s|%s|%%")
+upsert_re = re.compile(
+    r"^(\s*insert\s+into\s+(\S+?)\s*\(.*?)\s+"
+    r"on\s+duplicate\s+key\s+update\s+(.*)$", re.I | re.S)
+values_re = re.compile(r"values\s*\(\s*`?(\w+)`?\s*\)", re.I)
+
+
+def unquote(name):
+    return name.strip().strip('`')
+
+
+def split_definitions(body):
+    """Split the body of a create table statement on the commas that aren't
+    nested inside brackets or quotes.
+    """
+    items = []
+    depth = 0
+    quote = None
+    current = []
+    for c in body:
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            items.append(''.join(current).strip())
+            current = []
+            continue
+        current.append(c)
+    if ''.join(current).strip():
+        items.append(''.join(current).strip())
+    return items
+
+
+def translate_table(statement):
+    """Translate a single MySQL create table statement, returning the table
+    name, its primary key columns and the list of SQLite statements needed to
+    create it.
+    """
+    table = unquote(create_re.search(statement).group(1))
+    body = statement[statement.index('(') + 1:statement.rindex(')')]
+    items = split_definitions(body)
+    primary_key = []
+    for item in items:
+        match = primary_re.match(item)
+        if match:
+            primary_key = [unquote(c) for c in match.group(1).split(',')]
+    columns = []
+    names = []
+    indexes = []
+    on_update = []
+    timestamps = []
+    for item in items:
+        if primary_re.match(item):
+            columns.append(item)
+            continue
+        match = key_re.match(item)
+        if match:
+            indexes.append("create %sindex if not exists %s on %s (%s)" % (
+                "unique " if match.group(1) else "", unquote(match.group(2)),
+                table, match.group(3)))
+            continue
+        if re.match(r"(foreign|constraint)\s", item, re.I):
+            continue
+        item = column_comment_re.sub('', item)
+        name = unquote(item.split()[0])
+        names.append(name)
+        if on_update_re.search(item):
+            item = on_update_re.sub('', item)
+            on_update.append(name)
+        if item.split()[1].lower() == 'timestamp':
+            timestamps.append(name)
+        item = default_now_re.sub("default (%s)" % (now), item)
+        item = default_bool_re.sub(
+            lambda m: "default %d" % (m.group(1).lower() == 'true'), item)
+        # MySQL primary key columns are implicitly not null, SQLite's aren't
+        if name in primary_key and not re.search(r"not\s+null", item, re.I):
+            item += " not null"
+        columns.append(item)
+    statements = ["create table if not exists %s (\n    %s\n)" % (
+        table, ",\n    ".join(columns))] + indexes
+    trigger = (
+        "create trigger if not exists %(table)s_%(column)s_%(event)s "
+        "after %(event)s on %(table)s for each row when %(when)s begin "
+        "update %(table)s set %(column)s = %(now)s "
+        "where rowid = new.rowid; end"
+    )
+    for name in timestamps:
+        # explicitly setting a MySQL timestamp column to null sets it to the
+        # current time
+        statements.append(trigger % {
+            'table': table, 'column': name, 'event': 'insert', 'now': now,
+            'when': "new.%s is null" % (name)})
+    for name in on_update:
+        # on update current_timestamp only applies when the row changed and
+        # the column wasn't set as part of the update
+        changed = " or ".join("new.%s is not old.%s" % (c, c)
+                              for c in names if c != name)
+        statements.append(trigger % {
+            'table': table, 'column': name, 'event': 'update', 'now': now,
+            'when': "new.%s is old.%s and (%s)" % (name, name, changed)})
+    return (table, primary_key, statements)
+
+
+def translate_schema(schema):
+    """Translate the MySQL schema into SQLite, returning the list of
+    statements to run and a map of table names to their primary keys.
+    """
+    statements = []
+    primary_keys = {}
+    schema = comment_re.sub('', schema)
+    for statement in schema.split(';'):
+        if not create_re.search(statement):
+            continue
+        (table, primary_key, table_statements) = translate_table(statement)
+        primary_keys[table] = primary_key
+        statements.extend(table_statements)
+    return (statements, primary_keys)
+
+
+def read_schema(path):
+    if not os.path.isfile(path):
+        raise SQLiteError("Schema file %s not found" % (path))
+    opener = gzip.open if path.endswith('.gz') else open
+    f = opener(path)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+
+def translate_params(query):
+    def replace(match):
+        if match.group(1):
+            return ':' + match.group(1)
+        if match.group(0) == '%s':
+            return '?'
+        return '%'
+    return param_re.sub(replace, query)
+
+
+def translate_upsert(query, primary_keys):
+    match = upsert_re.match(query)
+    if not match:
+        return query
+    table = unquote(match.group(2))
+    if not primary_keys.get(table):
+        raise SQLiteError("No primary key known for table %s" % (table))
+    return "%s on conflict (%s) do update set %s" % (
+        match.group(1), ", ".join(primary_keys[table]),
+        values_re.sub(r"excluded.\1", match.group(3)))
+
+
+class SQLiteCursor(object):
+    """A cursor that behaves enough like a pymysql DictCursor for the entity
+    code - the rows are dicts, and queries are translated before they're run.
+
+    Like the default pymysql cursor the results are buffered, so rowcount
+    is available for selects.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.conn.cursor()
+        self.rows = []
+        self.rowcount = -1
+
+    def _run(self, method, query, args):
+        query = self.conn.translate(query, args is not None)
+        try:
+            if args is None:
+                method(query)
+            else:
+                method(query, args)
+        except sqlite3.Error as e:
+            logging.debug("Failed SQLite query: %s", query)
+            raise SQLiteError("%s: %s" % (e.__class__.__name__, e))
+        if self.cursor.description is not None:
+            self.rows = [dict((d[0], v) for (d, v) in
+                              zip(self.cursor.description, row))
+                         for row in self.cursor.fetchall()]
+            self.rowcount = len(self.rows)
+        else:
+            self.rows = []
+            self.rowcount = self.cursor.rowcount
+        return self.rowcount
+
+    def execute(self, query, args=None):
+        return self._run(self.cursor.execute, query, args)
+
+    def executemany(self, query, args):
+        return self._run(self.cursor.executemany, query, list(args))
+
+    def fetchone(self):
+        if not self.rows:
+            return None
+        return self.rows.pop(0)
+
+    def fetchmany(self, size=None):
+        size = size or 1
+        (rows, self.rows) = (self.rows[:size], self.rows[size:])
+        return rows
+
+    def fetchall(self):
+        (rows, self.rows) = (self.rows, [])
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection(object):
+    """Wrap a sqlite3 connection with the parts of the pymysql connection
+    interface that the pollster uses.
+    """
+
+    def __init__(self, path, schema, timeout=60.0):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=float(timeout),
+                                    detect_types=sqlite3.PARSE_DECLTYPES)
+        (statements, self.primary_keys) = translate_schema(
+            read_schema(schema))
+        for statement in statements:
+            self.conn.execute(statement)
+        self.conn.commit()
+        self._translated = {}
+
+    def translate(self, query, params=True):
+        key = (query, params)
+        if key not in self._translated:
+            translated = translate_upsert(query, self.primary_keys)
+            if params:
+                translated = translate_params(translated)
+            self._translated[key] = translated
+        return self._translated[key]
+
+    def cursor(self):
+        return SQLiteCursor(self)
+
+    def begin(self):
+        # as with MySQL, starting a transaction commits the current one
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+    def get_server_info(self):
+        return "SQLite %s (%s)" % (sqlite3.sqlite_version, self.path)
@@ -0,0 +1,178 @@
+#
+# Query level statistics - latency histograms, row counts and payload sizes
+# for every named query run through the DB layer.
+#
+# This is deliberately simple: a class level registry that is reset at the
+# start of each polling run and summarised at the end of it.
+#
+
+import logging
+import resource
+import sys
+import threading
+
+
+# upper bounds (in seconds) of the latency histogram buckets - anything
+# slower than the last bound lands in the overflow bucket
+latency_buckets = [0.001, 0.01, 0.1, 1.0, 10.0, 60.0]
+
+
+def estimate_size(rows, sample=100):
+    """Estimate the payload size (in bytes) of a query result or a set of
+    query parameters.
+
+    Walking every value of a large result set would cost nearly as much as
+    the query, so we measure an evenly spaced sample of rows and scale it up.
+    """
+    if not rows:
+        return 0
+    count = len(rows)
+    step = max(1, count // sample)
+    measured = 0
+    sampled = 0
+    for i in range(0, count, step):
+        row = rows[i]
+        if isinstance(row, dict):
+            values = row.values()
+        elif isinstance(row, (list, tuple)):
+            values = row
+        else:
+            values = [row]
+        for value in values:
+            if value is None:
+                measured += 1
+            elif isinstance(value, basestring):
+                measured += len(value)
+            else:
+                measured += 8
+        sampled += 1
+    return measured * count // sampled
+
+
+def estimate_memory(rows, sample=100):
+    """Estimate the memory (in bytes) taken up by a query result held as
+    python objects, which is typically several times the payload size.
+    """
+    if not rows:
+        return 0
+    count = len(rows)
+    step = max(1, count // sample)
+    measured = 0
+    sampled = 0
+    for i in range(0, count, step):
+        row = rows[i]
+        measured += sys.getsizeof(row)
+        if isinstance(row, dict):
+            values = row.values()
+        elif isinstance(row, (list, tuple)):
+            values = row
+        else:
+            values = []
+        for value in values:
+            measured += sys.getsizeof(value)
+        sampled += 1
+    return measured * count // sampled
+
+
+def peak_rss():
+    """The peak resident set size of the process so far, in bytes. This is
+    the peak over the process's whole lifetime, so it never goes down - and
+    the tables from the other sources are processed at the same time, so
+    there's no meaningful per-table figure to be had.
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class QueryStats(object):
+    """Collect per-query timing data.
+
+    Queries are identified by a name (generally '<table>.<query name>') and
+    the target they were run against ('remote' or 'local').
+    """
+
+    slow_query_threshold = None
+    _stats = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def new_record(cls):
+        return {
+            'count': 0,
+            'time': 0.0,
+            'max': 0.0,
+            'rows': 0,
+            'bytes': 0,
+            'histogram': [0] * (len(latency_buckets) + 1),
+        }
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._stats = {}
+
+    @classmethod
+    def _get_record(cls, target, name):
+        key = (target, name)
+        if key not in cls._stats:
+            cls._stats[key] = cls.new_record()
+        return cls._stats[key]
+
+    @classmethod
+    def record(cls, target, name, elapsed, rows=0, size=0):
+        """Record a single query execution.
+        """
+        bucket = len(latency_buckets)
+        for (i, bound) in enumerate(latency_buckets):
+            if elapsed <= bound:
+                bucket = i
+                break
+        with cls._lock:
+            r = cls._get_record(target, name)
+            r['count'] += 1
+            r['time'] += elapsed
+            r['max'] = max(r['max'], elapsed)
+            r['rows'] += max(rows, 0)
+            r['bytes'] += size
+            r['histogram'][bucket] += 1
+        if cls.slow_query_threshold and elapsed > cls.slow_query_threshold:
+            logging.warning("Slow %s query %s: %.3fs, %d rows",
+                            target, name, elapsed, max(rows, 0))
+
+    @classmethod
+    def record_fetch(cls, target, name, elapsed, size):
+        """Fetching is accounted against the query that produced the result,
+        without counting as a separate execution.
+        """
+        with cls._lock:
+            r = cls._get_record(target, name)
+            r['time'] += elapsed
+            r['bytes'] += size
+
+    @classmethod
+    def get_stats(cls):
+        with cls._lock:
+            return dict(cls._stats)
+
+    @classmethod
+    def total_time(cls, target):
+        return sum(r['time'] for ((t, n), r) in cls.get_stats().items()
+                   if t == target)
+
+    @classmethod
+    def report(cls):
+        """Produce a human readable summary of the collected statistics.
+        """
+        stats = cls.get_stats()
+        header = "<=" + " <=".join("%g" % (b) for b in latency_buckets)
+        lines = ["Query statistics (histogram buckets: %s >%g):" %
+                 (header, latency_buckets[-1])]
+        for (target, name) in sorted(stats.keys()):
+            r = stats[(target, name)]
+            lines.append(
+                "\t%s %s: count=%d total=%.3fs max=%.3fs rows=%d bytes=%d "
+                "histogram=%s" % (target, name, r['count'], r['time'],
+                                  r['max'], r['rows'], r['bytes'],
+                                  "/".join(str(c) for c in r['histogram']))
+            )
+        return "\n".join(lines)
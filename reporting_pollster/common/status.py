@@ -0,0 +1,243 @@
+#
+# Live status of the polling daemon - with --status-port (HTTP on localhost)
+# or --status-socket (HTTP over a Unix socket) a small server thread answers
+# every request with a JSON snapshot of what the pollster is doing: the poll
+# in progress and whether it's running late, the tables still queued for each
+# source, the table and phase each source is working on with its row counts
+# and ETA, the last successful refresh of every table, and the remote
+# connection pool and query counts.
+#
+# For example:
+#
+#   curl -s http://localhost:8642/
+#   curl -s --unix-socket /run/reporting-pollster.sock http://localhost/
+#
+
+import BaseHTTPServer
+from datetime import datetime
+from datetime import timedelta
+import json
+import logging
+import os
+import SocketServer
+import threading
+
+from reporting_pollster.common.DB import DB
+from reporting_pollster.common.stats import QueryStats
+
+
+def isoformat(value):
+    if value is None:
+        return None
+    return value.isoformat()
+
+
+class StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = json.dumps(Status.snapshot(), indent=2, sort_keys=True)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients don't have an address
+        return str(self.client_address or "local")
+
+    def log_message(self, fmt, *args):
+        logging.debug("Status request: " + fmt, *args)
+
+
+class StatusHTTPServer(SocketServer.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class StatusUnixServer(SocketServer.ThreadingMixIn,
+                       SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class Status(object):
+    """Track the progress of the polling loop, and serve it on request.
+    """
+
+    _lock = threading.Lock()
+    servers = []
+    poll_started = None
+    poll_period = None
+    last_poll = None
+    # source -> tables still to be processed in this poll
+    queues = {}
+    # source -> the entity being processed
+    current = {}
+    # table key -> {'finished': time, 'duration': seconds}
+    refreshed = {}
+
+    @classmethod
+    def enabled(cls):
+        return bool(cls.servers)
+
+    @classmethod
+    def start_poll(cls, period=None):
+        with cls._lock:
+            cls.poll_started = datetime.now()
+            cls.poll_period = period
+            cls.queues = {}
+
+    @classmethod
+    def finish_poll(cls, completed):
+        with cls._lock:
+            now = datetime.now()
+            cls.last_poll = {
+                'started': cls.poll_started,
+                'finished': now,
+                'duration': (now - cls.poll_started).total_seconds(),
+                'completed': completed,
+            }
+            cls.poll_started = None
+
+    @classmethod
+    def queue(cls, source, tables):
+        with cls._lock:
+            cls.queues[source] = list(tables)
+
+    @classmethod
+    def start_table(cls, entity, expected=None):
+        """Note that an entity is being processed - expected is how long it's
+        expected to take, in seconds.
+        """
+        with cls._lock:
+            queue = cls.queues.get(entity.source, [])
+            if entity.table in queue:
+                queue.remove(entity.table)
+            cls.current[entity.source] = {
+                'entity': entity,
+                'phase': 'starting',
+                'started': datetime.now(),
+                'expected': expected,
+            }
+
+    @classmethod
+    def phase(cls, entity, phase):
+        with cls._lock:
+            current = cls.current.get(entity.source)
+            if current and current['entity'] is entity:
+                current['phase'] = phase
+
+    @classmethod
+    def finish_table(cls, entity, key, error=None):
+        with cls._lock:
+            current = cls.current.pop(entity.source, None)
+            if error or not current:
+                return
+            now = datetime.now()
+            cls.refreshed[key] = {
+                'finished': now,
+                'duration': (now - current['started']).total_seconds(),
+            }
+
+    @staticmethod
+    def _describe(source, current, now):
+        entity = current['entity']
+        elapsed = now - current['started']
+        eta = None
+        progress = getattr(entity, 'progress', None)
+        if progress and progress['done']:
+            # rebuilds know how far through the segments they are
+            eta = now + (now - progress['started']) * (
+                progress['total'] - progress['done']) / progress['done']
+        elif current['expected'] is not None:
+            eta = current['started'] + timedelta(seconds=current['expected'])
+        return {
+            'table': entity.table,
+            'phase': current['phase'],
+            'mode': entity.mode,
+            'started': isoformat(current['started']),
+            'elapsed': elapsed.total_seconds(),
+            'rows_extracted': entity.rows_extracted,
+            'rows_written': entity.rows_written,
+            'progress': progress and {'done': progress['done'],
+                                      'total': progress['total']},
+            'eta': isoformat(eta),
+        }
+
+    @classmethod
+    def snapshot(cls):
+        now = datetime.now()
+        with cls._lock:
+            poll = None
+            if cls.poll_started:
+                poll = {
+                    'started': isoformat(cls.poll_started),
+                    'elapsed': (now - cls.poll_started).total_seconds(),
+                    'overdue': 0.0,
+                }
+                if cls.poll_period:
+                    # a poll that runs past the poll period delays the next
+                    # one - the backlog builds up from there
+                    due = cls.poll_started + timedelta(seconds=cls.poll_period)
+                    poll['overdue'] = max(0.0, (now - due).total_seconds())
+            last_poll = None
+            if cls.last_poll:
+                last_poll = dict(cls.last_poll,
+                                 started=isoformat(cls.last_poll['started']),
+                                 finished=isoformat(cls.last_poll['finished']))
+            status = {
+                'time': isoformat(now),
+                'pid': os.getpid(),
+                'poll': poll,
+                'last_poll': last_poll,
+                'queued': dict((s, list(q)) for (s, q) in cls.queues.items()),
+                'current': dict((s, cls._describe(s, c, now))
+                                for (s, c) in cls.current.items()),
+                'refreshed': dict(
+                    (k, {'finished': isoformat(r['finished']),
+                         'duration': r['duration']})
+                    for (k, r) in cls.refreshed.items()),
+            }
+        queries = {}
+        for ((target, name), r) in QueryStats.get_stats().items():
+            queries.setdefault(target, {'count': 0, 'time': 0.0})
+            queries[target]['count'] += r['count']
+            queries[target]['time'] += r['time']
+        status['queries'] = queries
+        status['connections'] = DB.pool_stats()
+        return status
+
+    @classmethod
+    def _start_server(cls, server, description):
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        cls.servers.append(server)
+        logging.info("Serving status on %s", description)
+
+    @classmethod
+    def serve(cls, port=None, socket_path=None):
+        """Start the status servers - the HTTP server only listens on
+        localhost.
+        """
+        if port:
+            cls._start_server(StatusHTTPServer(('127.0.0.1', port),
+                                               StatusHandler),
+                              "port %d" % (port))
+        if socket_path:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            cls._start_server(StatusUnixServer(socket_path, StatusHandler),
+                              socket_path)
+
+    @classmethod
+    def stop(cls):
+        for server in cls.servers:
+            server.shutdown()
+            server.server_close()
+            if isinstance(server, StatusUnixServer):
+                try:
+                    os.remove(server.server_address)
+                except OSError:
+                    pass
+        cls.servers = []
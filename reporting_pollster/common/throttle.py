@@ -0,0 +1,186 @@
+#
+# Source side throttling - limit the rate at which we query the remote
+# databases, which are the production OpenStack databases.
+#
+# Each remote source gets a token bucket for queries and another for rows, and
+# the rates they refill at are divided by a backoff factor. The backoff goes
+# up whenever the source looks busy (a query runs much slower than it normally
+# does, or Threads_running is over the limit) and decays again once it
+# settles down.
+#
+
+import logging
+import threading
+import time
+
+
+class Throttle(object):
+    """Rate limit the queries run against the remote sources.
+
+    Throttling is configured from the [throttle] section of the config file,
+    and is disabled unless at least one of the rates is set.
+    """
+
+    # budgets - None means unlimited
+    queries_per_second = None
+    rows_per_second = None
+    # back off when a query takes this many times longer than usual
+    latency_factor = 3.0
+    # queries faster than this are too noisy to judge latency by
+    min_latency = 0.1
+    # back off when the source reports more running threads than this
+    threads_running = None
+    # how often (in seconds) to check Threads_running on each source
+    check_interval = 10.0
+    max_backoff = 16.0
+
+    settings = [
+        ('queries_per_second', float),
+        ('rows_per_second', float),
+        ('latency_factor', float),
+        ('min_latency', float),
+        ('threads_running', int),
+        ('check_interval', float),
+        ('max_backoff', float),
+    ]
+
+    _state = {}
+    _baselines = {}
+    _waited = 0.0
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, settings):
+        for (name, convert) in cls.settings:
+            if name in settings:
+                setattr(cls, name, convert(settings[name]))
+        cls._state = {}
+        cls._baselines = {}
+        cls._waited = 0.0
+        if cls.enabled():
+            logging.info("Throttling remote queries: %s queries/s, %s rows/s",
+                         cls.queries_per_second or "unlimited",
+                         cls.rows_per_second or "unlimited")
+
+    @classmethod
+    def enabled(cls):
+        return bool(cls.queries_per_second or cls.rows_per_second)
+
+    @classmethod
+    def reset(cls):
+        """Reset the per-poll wait time. The backoff and latency baselines are
+        carried over from one polling run to the next.
+        """
+        with cls._lock:
+            cls._waited = 0.0
+
+    @classmethod
+    def total_wait(cls):
+        return cls._waited
+
+    @classmethod
+    def _get_state(cls, source):
+        # call with the lock held
+        if source not in cls._state:
+            cls._state[source] = {
+                'queries': cls.queries_per_second or 0.0,
+                'rows': cls.rows_per_second or 0.0,
+                'updated': time.time(),
+                'checked': 0.0,
+                'backoff': 1.0,
+            }
+        state = cls._state[source]
+        now = time.time()
+        elapsed = now - state['updated']
+        state['updated'] = now
+        for (bucket, rate) in (('queries', cls.queries_per_second),
+                               ('rows', cls.rows_per_second)):
+            if rate:
+                state[bucket] = min(rate, state[bucket] +
+                                    elapsed * rate / state['backoff'])
+        return state
+
+    @classmethod
+    def _adjust(cls, state, source, busy, reason):
+        # call with the lock held
+        backoff = state['backoff']
+        if busy:
+            state['backoff'] = min(cls.max_backoff, backoff * 2)
+        else:
+            state['backoff'] = max(1.0, backoff * 0.8)
+        if state['backoff'] > backoff:
+            logging.info("Throttle backing off on %s (%s): %.1fx", source,
+                         reason, state['backoff'])
+        elif state['backoff'] == 1.0 and backoff > 1.0:
+            logging.info("Throttle back to full rate on %s", source)
+
+    @classmethod
+    def load_check_due(cls, source):
+        if not cls.enabled() or not cls.threads_running:
+            return False
+        with cls._lock:
+            state = cls._get_state(source)
+            if time.time() - state['checked'] < cls.check_interval:
+                return False
+            state['checked'] = time.time()
+            return True
+
+    @classmethod
+    def record_load(cls, source, threads_running):
+        if threads_running is None:
+            return
+        with cls._lock:
+            state = cls._get_state(source)
+            cls._adjust(state, source, threads_running > cls.threads_running,
+                        "Threads_running %d" % (threads_running))
+
+    @classmethod
+    def wait(cls, source):
+        """Wait until the source's budget allows another query to be run.
+        """
+        if not cls.enabled():
+            return 0.0
+        waited = 0.0
+        while True:
+            with cls._lock:
+                state = cls._get_state(source)
+                delay = 0.0
+                if cls.queries_per_second and state['queries'] < 1:
+                    delay = ((1 - state['queries']) * state['backoff'] /
+                             cls.queries_per_second)
+                # rows are charged after the fact, so a big result set puts
+                # the bucket into debt that has to be paid off first
+                if cls.rows_per_second and state['rows'] < 0:
+                    delay = max(delay, -state['rows'] * state['backoff'] /
+                                cls.rows_per_second)
+                if not delay:
+                    if cls.queries_per_second:
+                        state['queries'] -= 1
+                    cls._waited += waited
+                    return waited
+            time.sleep(delay)
+            waited += delay
+
+    @classmethod
+    def record(cls, source, name, elapsed, rows):
+        """Charge a completed query against the budget, and check its latency
+        against the usual latency for that query.
+        """
+        if not cls.enabled():
+            return
+        with cls._lock:
+            state = cls._get_state(source)
+            if cls.rows_per_second:
+                state['rows'] -= max(rows, 0)
+            key = (source, name)
+            baseline = cls._baselines.get(key)
+            if baseline is None:
+                cls._baselines[key] = elapsed
+                return
+            cls._baselines[key] = 0.8 * baseline + 0.2 * elapsed
+            if cls.latency_factor:
+                busy = (elapsed > cls.min_latency and
+                        elapsed > baseline * cls.latency_factor)
+                cls._adjust(state, source, busy,
+                            "%s took %.3fs, usually %.3fs" % (name, elapsed,
+                                                             baseline))
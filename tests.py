@@ -1,18 +1,47 @@
 #!/usr/bin/env python
+from argparse import Namespace
+from ConfigParser import SafeConfigParser
 import copy
 import datetime
+import json
+import os
 import pickle
+import shutil
+import socket
+import tempfile
+import time
 import unittest
 
 from mock import MagicMock
 from mock import patch
+from pymysql.err import MySQLError
 
+from reporting_pollster.common.apicache import ApiCache
+from reporting_pollster.common.bulk import BulkLoad
+from reporting_pollster.common.config import Config
+from reporting_pollster.common.DB import DB
+from reporting_pollster.common.DB import InstrumentedCursor
+from reporting_pollster.common.deadline import Deadline
+from reporting_pollster.common.deadline import DeadlineExceeded
+from reporting_pollster.common.export import Export
+from reporting_pollster.common.history import RunHistory
+from reporting_pollster.common.replay import Replay
+from reporting_pollster.common.replay import ReplayError
+from reporting_pollster.common.replay import ReplayResource
+from reporting_pollster.common.sqlite import translate_schema
+from reporting_pollster.common.stats import QueryStats
+from reporting_pollster.common.status import Status
+from reporting_pollster.common.throttle import Throttle
 from reporting_pollster.entities.entities import Aggregate
 from reporting_pollster.entities.entities import Allocation
 from reporting_pollster.entities.entities import Entity
 from reporting_pollster.entities.entities import Hypervisor
+from reporting_pollster.entities.entities import Image
+from reporting_pollster.entities.entities import HypervisorUtilisation
 from reporting_pollster.entities.entities import Instance
 from reporting_pollster.entities.entities import Project
+from reporting_pollster.entities.entities import data_version
+from reporting_pollster.entities.entities import summarise_explain
 
 
 # What to test . . .
@@ -452,6 +481,28 @@ project_allocations = [
 ]
 
 
+explain_data = [
+    {
+        'id': 1,
+        'select_type': 'PRIMARY',
+        'table': 'kp',
+        'type': 'ALL',
+        'key': None,
+        'rows': 5000,
+        'Extra': 'Using temporary; Using filesort',
+    },
+    {
+        'id': 1,
+        'select_type': 'PRIMARY',
+        'table': 'r',
+        'type': 'ref',
+        'key': 'quotas_project_id_idx',
+        'rows': 3,
+        'Extra': None,
+    },
+]
+
+
 def create_mock_array(data):
     accum = []
     for i in data:
@@ -513,6 +564,97 @@ class test_all(unittest.TestCase):
         self.assertEqual(hyp.data[0]['availability_zone'], 'az1')
         self.assertEqual(hyp.data[4]['availability_zone'], 'az2')
 
+    @patch('reporting_pollster.entities.entities.DB')
+    @patch('reporting_pollster.entities.entities.Config')
+    def test_hypervisor_db_extract(self, Config, DB):
+        Config.get_dbs.return_value = {"nova": "nova"}
+        cursor = DB.remote_cursor.return_value
+        cursor.fetchall.return_value = [
+            {'id': 1, 'availability_zone': 'nova',
+             'hypervisor_hostname': 'test01.example.com',
+             'host_ip': '1.2.3.1', 'vcpus': 32, 'memory_mb': 262144,
+             'local_gb': 2000, 'deleted': 0},
+            {'id': 2, 'availability_zone': 'nova',
+             'hypervisor_hostname': 'test06.example.com',
+             'host_ip': '1.2.3.6', 'vcpus': 32, 'memory_mb': 262144,
+             'local_gb': 2000, 'deleted': 0, 'cell_name': 'cell1'},
+            {'id': 3, 'availability_zone': 'nova',
+             'hypervisor_hostname': 'test07.example.com',
+             'host_ip': '1.2.3.7', 'vcpus': 32, 'memory_mb': 262144,
+             'local_gb': 2000, 'deleted': 3}]
+        hyp = Hypervisor(MagicMock(full_run=True))
+        with patch.object(hyp, 'get_last_update', return_value=None):
+            hyp.extract()
+        self.assertFalse(hyp.novaclient.hypervisors.list.called)
+        hyp.hypervisor_az_data = hypervisor_az_data
+        hyp.transform()
+        self.assertEqual([(r['id'], r['availability_zone'], r['host'])
+                          for r in hyp.data],
+                         [(1, 'az1', 'test01'), (2, 'cell1', 'test06')])
+
+        # the API is only used when the database can't be read
+        cursor.execute.side_effect = MySQLError("denied")
+        hyp = Hypervisor(MagicMock(full_run=True))
+        with patch.object(hyp, 'get_last_update', return_value=None):
+            hyp.extract()
+            self.assertEqual(hyp.api_data,
+                             hyp.novaclient.hypervisors.list.return_value)
+            hyp.hypervisor_source = 'db'
+            self.assertRaises(MySQLError, hyp.extract)
+
+        # or has no live compute nodes, as under cells v1
+        cursor.execute.side_effect = None
+        cursor.fetchall.return_value = []
+        hyp = Hypervisor(MagicMock(full_run=True))
+        with patch.object(hyp, 'get_last_update', return_value=None):
+            hyp.extract()
+            self.assertTrue(hyp.novaclient.hypervisors.list.called)
+            hyp.novaclient.reset_mock()
+            hyp = Hypervisor(MagicMock(full_run=True))
+            hyp.hypervisor_source = 'db'
+            hyp.extract()
+            self.assertFalse(hyp.novaclient.hypervisors.list.called)
+            self.assertEqual(hyp.db_data, [])
+
+    @patch('reporting_pollster.entities.entities.Config')
+    def test_hypervisor_utilisation_transform(self, Config):
+        inst = Instance(self.args)
+        inst.db_data = copy.deepcopy(instance_data)
+        inst.hypervisor_az_data = hypervisor_az_data
+        inst.transform()
+        # instance 3 has been deleted, so test05 has nothing allocated
+        self.assertEqual(inst.hypervisor_allocation_data,
+                         {'test03': [1, 2048, 70], 'test04': [1, 2048, 70]})
+        util = HypervisorUtilisation(self.args)
+        util.this_update_start = datetime.datetime(2016, 3, 4, 13, 46, 2)
+        util.db_data = [
+            {'host': h['host'], 'vcpus': h['vcpus'], 'vcpus_used': 2,
+             'memory_mb': h['memory_mb'], 'memory_mb_used': 4096,
+             'local_gb': h['local_gb'], 'local_gb_used': 100}
+            for h in hypervisor_data
+        ]
+        util.hypervisor_allocation_data = inst.hypervisor_allocation_data
+        util.transform()
+        self.assertEqual(len(util.data), 15)
+        self.assertEqual([(r['resolution'], r['sample_time'])
+                          for r in util.data if r['host'] == 'test03'], [
+            (0, datetime.datetime(2016, 3, 4, 13, 46, 2)),
+            (3600, datetime.datetime(2016, 3, 4, 13)),
+            (86400, datetime.datetime(2016, 3, 4)),
+        ])
+        test03 = util.data[2]
+        self.assertEqual(test03['host'], 'test03')
+        self.assertEqual(test03['cpus'], 32)
+        self.assertEqual(test03['vcpus_allocated'], 1)
+        self.assertEqual(test03['local_storage_allocated'], 70)
+        self.assertEqual(util.data[4]['vcpus_allocated'], 0)
+
+        # no instance data means no sample
+        util = HypervisorUtilisation(self.args)
+        util.db_data = [{'host': 'test01'}]
+        util.transform()
+        self.assertEqual(util.data, [])
+
     @patch('novaclient.client')
     @patch('reporting_pollster.entities.entities.Config')
     def test_project_transform(self, Config, nvclient):
@@ -523,8 +665,11 @@ class test_all(unittest.TestCase):
         proj.db_data = proj_db_data
         proj.tenant_owner_data = proj_tenant_owner_data
         proj.tenant_member_data = proj_tenant_member_data
+        proj.has_instance_data = {'uuid1': True, 'uuid3': True}
         proj.transform()
         self.assertEqual(len(proj.data), 3)
+        self.assertEqual([p['has_instances'] for p in proj.data],
+                         [True, False, True])
         # project 1 is owned by A real University
         self.assertEqual(proj.data[0]['organisation'],
                          "A real University")
@@ -535,6 +680,72 @@ class test_all(unittest.TestCase):
         self.assertEqual(proj.data[-1]['organisation'],
                          "somewhere.entirely.else")
 
+    @patch('reporting_pollster.entities.entities.DB')
+    @patch('reporting_pollster.entities.entities.Config')
+    def test_project_has_instances(self, Config, DB):
+        cursor = DB.local_cursor.return_value
+        cursor.fetchall.return_value = [{'project_id': 'uuid1'},
+                                        {'project_id': 'uuid3'}]
+        proj = Project(MagicMock(full_run=True))
+        proj._extract_has_instances()
+        self.assertEqual(proj.has_instance_data,
+                         {'uuid1': True, 'uuid3': True})
+        self.assertEqual(cursor.execute.call_args[1]['name'],
+                         'project.has_instances')
+        self.assertFalse(DB.remote_cursor.called)
+
+    @patch('reporting_pollster.entities.entities.Config')
+    @patch('reporting_pollster.common.DB.Config')
+    def test_project_first_poll(self, DBConfig, Config):
+        DBConfig.get_local.return_value = {
+            'backend': 'sqlite', 'path': ':memory:',
+            'schema': 'data/reporting_schema_nectar.sql'}
+        DBConfig.get_local_backend.return_value = 'sqlite'
+        Config.get_dbs.return_value = {"nova": "nova", "keystone": "keystone",
+                                       "cinder": "cinder",
+                                       "rcshibboleth": "rcshibboleth"}
+        DB.local_conns.conn = None
+        args = Namespace(full_run=True, last_update_window=0)
+        results = {
+            'instance.query': [dict(instance_data[0], id='i1', deleted=None,
+                                    changed_at=instance_data[0]['created'],
+                                    availability_zone=None,
+                                    cell_name=None)],
+            'project.query': copy.deepcopy(proj_db_data),
+        }
+
+        class Cursor(object):
+            # the subqueries run on their own pooled cursors in other threads
+            rowcount = 0
+
+            def execute(self, query, params=None, name=None):
+                self.name = name
+
+            def fetchall(self):
+                return copy.deepcopy(results.get(self.name, []))
+        # project comes after instance when both are polled, so a fresh
+        # database gets has_instances from this poll's instances
+        tables = Entity.get_table_names(user_tables=['project', 'instance'])
+        self.assertEqual(tables, ['aggregate', 'instance', 'project'])
+        try:
+            with patch.object(DB, 'remote_cursor') as remote_cursor, \
+                    patch.object(DB, 'remote_connection'), \
+                    patch.object(DB, 'release_remote_connection'), \
+                    patch.object(DB, 'pooled_cursor') as pooled_cursor:
+                remote_cursor.side_effect = lambda *a, **k: Cursor()
+                pooled_cursor.side_effect = lambda *a, **k: Cursor()
+                for table in tables[1:]:
+                    Entity.from_table_name(table, args).process()
+            cursor = DB.local_cursor()
+            cursor.execute("select id, has_instances from project")
+            self.assertEqual(
+                sorted((r['id'], r['has_instances'])
+                       for r in cursor.fetchall()),
+                [('uuid1', 1), ('uuid2', 0), ('uuid3', 0)])
+        finally:
+            DB.local_conns.conn = None
+            Entity.drop_cached_data()
+
     @patch('novaclient.client')
     @patch('reporting_pollster.entities.entities.Config')
     def test_instance_transform(self, Config, nvclient):
@@ -544,8 +755,6 @@ class test_all(unittest.TestCase):
         inst.db_data = copy.deepcopy(instance_data)
         inst.hypervisor_az_data = hypervisor_az_data
         inst.transform()
-        self.assertEqual(len(inst.has_instance_data), 2)
-        self.assertEqual(inst.has_instance_data['uuid1'], True)
         self.assertEqual(inst.hist_agg_data[0]['vcpus'], 1)
         self.assertEqual(inst.hist_agg_data[1]['vcpus'], 6)
         self.assertEqual(inst.hist_agg_data[2]['vcpus'], 2)
@@ -559,6 +768,234 @@ class test_all(unittest.TestCase):
         self.assertEqual(inst.data[0]['availability_zone'], 'az1')
         self.assertEqual(inst.data[2]['availability_zone'], 'az2')
 
+    @patch('reporting_pollster.entities.entities.Config')
+    def test_instance_rollups(self, Config):
+        inst = Instance(self.args)
+        inst.db_data = copy.deepcopy(instance_data)
+        inst.hypervisor_az_data = hypervisor_az_data
+        inst.transform()
+        self.assertEqual(inst.hist_agg_start,
+                         datetime.datetime(2015, 11, 22))
+        first_day = [r for r in inst.hist_agg_project_data
+                     if r['day'] == inst.hist_agg_start]
+        self.assertEqual(len(first_day), 1)
+        self.assertEqual(first_day[0]['project_id'], 'uuid1')
+        second_day = dict((r['project_id'], r['vcpus'])
+                          for r in inst.hist_agg_project_data
+                          if r['day'] == datetime.datetime(2015, 11, 23))
+        self.assertEqual(second_day, {'uuid1': 5, 'uuid3': 1})
+        second_day = dict((r['availability_zone'], r['memory'])
+                          for r in inst.hist_agg_az_data
+                          if r['day'] == datetime.datetime(2015, 11, 23))
+        self.assertEqual(second_day, {'az1': 2048, 'az2': 10144})
+        # the rollups add up to the cloud-wide totals
+        for hist in inst.hist_agg_data:
+            self.assertEqual(hist['local_storage'],
+                             sum(r['local_storage']
+                                 for r in inst.hist_agg_az_data
+                                 if r['day'] == hist['day']))
+
+    @patch('reporting_pollster.entities.entities.DB')
+    @patch('reporting_pollster.entities.entities.Config')
+    def test_instance_rebuild(self, Config, DB):
+        Config.get_dbs.return_value = {"nova": "nova"}
+        args = Namespace(full_run=True, last_update_window=0, rebuild=True,
+                         rebuild_segment_days=30)
+        inst = Instance(args)
+        inst.this_update_start = datetime.datetime(2016, 3, 1, 12)
+        DB.remote_cursor.return_value.fetchall.return_value = [
+            {'created': datetime.datetime(2016, 1, 15, 10)}]
+        segments = inst._plan_rebuild('instance')
+        self.assertEqual([(s['segment_start'], s['segment_end'])
+                          for s in segments],
+                         [(datetime.datetime(2016, 1, 15),
+                           datetime.datetime(2016, 2, 14)),
+                          (datetime.datetime(2016, 2, 14),
+                           datetime.datetime(2016, 3, 1, 12))])
+
+        # resume a rebuild with the first segment already done
+        segments[0]['completed'] = datetime.datetime(2016, 3, 1, 13)
+        local = DB.local_cursor.return_value
+        local.fetchall.side_effect = [
+            segments,
+            [{'project_id': 'uuid1', 'hypervisor': 'test03', 'vcpus': 1,
+              'memory': 2048, 'local_storage': 70, 'active': True},
+             {'project_id': 'uuid3', 'hypervisor': 'test04', 'vcpus': 4,
+              'memory': 8096, 'local_storage': 170, 'active': False}],
+        ]
+        DB.remote_cursor.return_value.fetchall.return_value = [
+            dict(instance_data[2], created=datetime.datetime(2016, 2, 20),
+                 deleted=None)]
+        with patch.object(Entity, '_cache', {}), \
+                patch.object(Entity, 'rebuilt', set()):
+            inst.process()
+            self.assertEqual(
+                Entity._get_cached_data('hypervisor_allocation'),
+                {'test03': [1, 2048, 70]})
+            self.assertEqual(Entity.rebuilt, set(['instance']))
+        self.assertEqual(DB.remote_cursor.return_value.execute.call_count, 2)
+        params = DB.remote_cursor.return_value.execute.call_args[0][1]
+        self.assertEqual(params['segment_start'],
+                         datetime.datetime(2016, 2, 14))
+        # the usage is added to the totals from the earlier segments
+        loads = [c[1]['name'] for c in local.executemany.call_args_list]
+        self.assertEqual(loads, ['instance.update', 'instance.hist_agg_add',
+                                 'instance.hist_agg_project_add',
+                                 'instance.hist_agg_az_add'])
+        hist = local.executemany.call_args_list[1][0][1]
+        self.assertEqual(hist[0]['day'], datetime.datetime(2016, 2, 20))
+        self.assertEqual(hist[-1]['day'], datetime.datetime(2016, 2, 29))
+        names = [c[1]['name'] for c in local.execute.call_args_list]
+        self.assertEqual(names[:3], ['rebuild_checkpoint.segments',
+                                     'rebuild_checkpoint.complete',
+                                     'rebuild_checkpoint.finish'])
+        self.assertEqual(segments[1]['row_count'], 1)
+
+    @patch('reporting_pollster.entities.entities.DB')
+    @patch('reporting_pollster.entities.entities.Config')
+    def test_rebuild_resume(self, Config, DB):
+        Config.get_dbs.return_value = {"nova": "nova"}
+        local = DB.local_cursor.return_value
+        args = Namespace(full_run=True, last_update_window=0)
+        steps = ['rebuild', 'extract', 'transform', 'load', 'export']
+
+        def process(args, pending):
+            local.fetchone.return_value = {'segments': pending}
+            inst = Instance(args)
+            with patch.multiple(inst, **dict((s, MagicMock())
+                                             for s in steps)):
+                inst.process()
+                return [s for s in steps if getattr(inst, s).called]
+
+        with patch.object(Entity, 'rebuilt', set()):
+            # an interrupted rebuild is carried on without --rebuild
+            self.assertEqual(process(args, 2), ['rebuild'])
+            self.assertEqual(process(args, 0), steps[1:])
+            # and --rebuild doesn't redo a table that's been rebuilt
+            args.rebuild = True
+            self.assertEqual(process(args, 0), ['rebuild'])
+            Entity.rebuilt.add('instance')
+            self.assertEqual(process(args, 0), steps[1:])
+        local.fetchall.return_value = [{'table_name': 'instance'}]
+        self.assertEqual(Entity.get_pending_rebuilds(), ['instance'])
+
+    @patch('reporting_pollster.entities.entities.DB')
+    @patch('reporting_pollster.entities.entities.Config')
+    def test_memory_budget(self, Config, DB):
+        Config.get_dbs.return_value = {"nova": "nova"}
+        args = Namespace(full_run=True, last_update_window=0,
+                         force_update=True, memory_budget=1,
+                         rebuild_segment_days=60)
+        inst = Instance(args)
+        inst.db_data = copy.deepcopy(instance_data)
+        inst._measure_rows()
+        self.assertTrue(inst.row_width > 100)
+
+        # 4MB of instance data needs four segments
+        local = DB.local_cursor.return_value
+        local.fetchone.return_value = {'row_count': 4096, 'row_width': 1024}
+        self.assertEqual(inst._check_memory_budget(), 4)
+        inst.rebuild_segments = 4
+        inst.this_update_start = datetime.datetime(2016, 3, 1)
+        DB.remote_cursor.return_value.fetchall.return_value = [
+            {'created': datetime.datetime(2015, 11, 1)}]
+        segments = inst._plan_rebuild('instance')
+        self.assertEqual(len(segments), 4)
+        self.assertEqual(segments[1]['segment_start'],
+                         datetime.datetime(2015, 12, 1, 6))
+
+        # it fits, or there's nothing to go on
+        local.fetchone.return_value = {'row_count': 512, 'row_width': 1024}
+        self.assertEqual(inst._check_memory_budget(), None)
+        local.fetchone.return_value = {'row_count': 4096, 'row_width': None}
+        self.assertEqual(inst._check_memory_budget(), None)
+        # incremental updates aren't checked
+        del args.force_update
+        local.fetchone.return_value = {
+            'row_count': 4096, 'row_width': 1024,
+            'last_update': datetime.datetime(2016, 2, 29)}
+        self.assertEqual(inst._check_memory_budget(), None)
+        # and entities that can't be split up are processed normally
+        proj = Project(Namespace(full_run=True, last_update_window=0,
+                                 memory_budget=1))
+        self.assertEqual(proj._check_memory_budget(), None)
+
+    @patch('reporting_pollster.entities.entities.Config')
+    @patch('reporting_pollster.common.DB.Config')
+    def test_memory_budget_resume(self, DBConfig, Config):
+        DBConfig.get_local.return_value = {
+            'backend': 'sqlite', 'path': ':memory:',
+            'schema': 'data/reporting_schema_nectar.sql'}
+        DBConfig.get_local_backend.return_value = 'sqlite'
+        Config.get_dbs.return_value = {"nova": "nova"}
+        DB.local_conns.conn = None
+        args = Namespace(full_run=True, last_update_window=0,
+                         force_update=True, memory_budget=1)
+        results = [[{'created': datetime.datetime(2016, 1, 15)}],
+                   [dict(instance_data[2], id='i1', deleted=None,
+                         created=datetime.datetime(2016, 1, 20),
+                         availability_zone=None, cell_name=None)],
+                   MySQLError("gone away")]
+
+        def fetchall():
+            result = results.pop(0) if results else []
+            if isinstance(result, Exception):
+                raise result
+            return result
+        try:
+            cursor = DB.local_cursor()
+            cursor.execute("insert into metadata (table_name, last_update, "
+                           "row_count, row_width) values (%s, %s, %s, %s)",
+                           ('instance', datetime.datetime(2016, 2, 29), 4096,
+                            1024))
+            DB.local().commit()
+            with patch.object(DB, 'remote_cursor') as remote_cursor, \
+                    patch.object(Entity, 'rebuilt', set()):
+                remote_cursor.return_value.fetchall.side_effect = fetchall
+                # the over-budget extraction is split up, and interrupted
+                self.assertRaises(MySQLError, Instance(args).process)
+                cursor.execute("select count(*) as segments, "
+                               "count(completed) as completed "
+                               "from rebuild_checkpoint")
+                row = cursor.fetchone()
+                self.assertEqual(row['completed'], 1)
+                self.assertTrue(row['segments'] > 1)
+                # the next regular update has a last_update, so it wouldn't
+                # check the budget - but it carries on with the rebuild
+                del args.force_update
+                inst = Instance(args)
+                inst.process()
+                self.assertEqual(inst.mode, 'rebuild')
+            self.assertEqual(Entity.get_pending_rebuilds(), [])
+            cursor.execute("select id from instance")
+            self.assertEqual([r['id'] for r in cursor.fetchall()], ['i1'])
+        finally:
+            DB.local_conns.conn = None
+            Entity.drop_cached_data()
+
+    @patch('reporting_pollster.entities.entities.Config')
+    def test_instance_transform_sharded(self, Config):
+        inst = Instance(self.args)
+        inst.db_data = copy.deepcopy(instance_data)
+        inst.hypervisor_az_data = hypervisor_az_data
+        inst.transform()
+        sharded = Instance(Namespace(full_run=False, last_update_window=0,
+                                     transform_workers=2))
+        sharded.min_shard_size = 1
+        sharded.db_data = copy.deepcopy(instance_data)
+        sharded.hypervisor_az_data = hypervisor_az_data
+        self.assertEqual(len(sharded._get_shards(None, None)[0]), 2)
+        try:
+            Instance.start_workers(2)
+            sharded.transform()
+        finally:
+            Instance.stop_workers()
+        self.assertEqual(sharded.hist_agg_data, inst.hist_agg_data)
+        self.assertEqual(sharded.hist_agg_project_data,
+                         inst.hist_agg_project_data)
+        self.assertEqual(sharded.hist_agg_az_data, inst.hist_agg_az_data)
+        self.assertEqual(sharded.data, inst.data)
+
     @patch('novaclient.client')
     @patch('reporting_pollster.entities.entities.Config')
     def test_format_query(self, Config, nvclient):
@@ -586,6 +1023,848 @@ class test_all(unittest.TestCase):
         self.assertIsNone(allocs.data[3]['project_id'])
         self.assertIsNone(allocs.data[4]['project_id'])
 
+    def test_summarise_explain(self):
+        summary = summarise_explain(explain_data)
+        self.assertEqual(summary['rows'], 5003)
+        self.assertEqual(summary['full_scans'], ['kp'])
+        self.assertEqual(summary['keys'], ['r.quotas_project_id_idx'])
+        self.assertTrue(summary['filesort'])
+        self.assertTrue(summary['temporary'])
+        self.assertEqual(Entity._null_params("update t set a=%(a)s, b=%(b)s"),
+                         {'a': None, 'b': None})
+        self.assertEqual(Entity._null_params("delete from t where a = %s"),
+                         (None, ))
+        self.assertIsNone(Entity._null_params("update t set active=0"))
+
+    def test_query_stats(self):
+        QueryStats.reset()
+        cursor = MagicMock(rowcount=3)
+        cursor.fetchall.return_value = [
+            {'id': 'uuid1', 'vcpus': 1},
+            {'id': 'uuid2', 'vcpus': 2},
+            {'id': 'uuid3', 'vcpus': None},
+        ]
+        ic = InstrumentedCursor(cursor, 'remote')
+        ic.execute("select id, vcpus from instances", name='instance.query')
+        rows = ic.fetchall()
+        self.assertEqual(len(rows), 3)
+        QueryStats.record('local', 'instance.update', 120.0, 10)
+        stats = QueryStats.get_stats()
+        record = stats[('remote', 'instance.query')]
+        self.assertEqual(record['count'], 1)
+        self.assertEqual(record['rows'], 3)
+        # 5 characters per uuid, 8 bytes per int and 1 byte per null
+        self.assertEqual(record['bytes'], 3 * 5 + 2 * 8 + 1)
+        self.assertEqual(sum(record['histogram']), 1)
+        self.assertEqual(stats[('local', 'instance.update')]['histogram'][-1],
+                         1)
+        self.assertEqual(QueryStats.total_time('local'), 120.0)
+        QueryStats.reset()
+
+    @patch('reporting_pollster.entities.entities.Config')
+    def test_export(self, Config):
+        args = Namespace(full_run=True, last_update_window=0,
+                         export_dir='/export', export_format='parquet',
+                         export_compression='snappy')
+        inst = Instance(args)
+        inst.this_update_start = datetime.datetime(2015, 11, 25, 1, 2, 3)
+        inst.db_data = copy.deepcopy(instance_data)
+        inst.hypervisor_az_data = hypervisor_az_data
+        inst.transform()
+        with patch.object(Export, 'available', return_value=True), \
+                patch.object(Export, '_write_file') as write_file:
+            inst.export()
+        paths = [c[0][0] for c in write_file.call_args_list]
+        self.assertEqual(paths[0], '/export/instance/day=2015-11-25/'
+                         'instance-20151125T010203-default.parquet')
+        # historical usage is partitioned on its own day column
+        self.assertEqual(paths[1], '/export/historical_usage/day=2015-11-22/'
+                         'historical_usage-20151125T010203-default.parquet')
+        self.assertEqual(len(paths), 1 + len(inst.hist_agg_data))
+        self.assertEqual(len(write_file.call_args_list[0][0][1]), 3)
+        # rebuild segments only have part of each day's usage, so it's
+        # exported in full at the end
+        with patch.object(Export, 'available', return_value=True), \
+                patch.object(Export, '_write_file') as write_file, \
+                patch('reporting_pollster.entities.entities.DB') as DB:
+            inst.export(inst._segment_exports(), part="segment001")
+            DB.local_cursor.return_value.fetchall.return_value = [
+                {'day': datetime.date(2015, 11, 24), 'vcpus': 3,
+                 'memory': 8192, 'local_storage': 100, 'source': 'default'}]
+            inst.export(inst._rebuild_exports())
+        paths = [c[0][0] for c in write_file.call_args_list]
+        self.assertEqual(paths, [
+            '/export/instance/day=2015-11-25/'
+            'instance-20151125T010203-default-segment001.parquet',
+            '/export/historical_usage/day=2015-11-24/'
+            'historical_usage-20151125T010203-default.parquet'])
+        # nothing is written in a dry run
+        inst.dry_run = True
+        with patch.object(Export, '_write_file') as write_file:
+            inst.export()
+        self.assertFalse(write_file.called)
+
+    @patch('reporting_pollster.common.bulk.DB')
+    def test_bulk_load(self, DB):
+        self.assertEqual(Entity.get_local_tables(['instance', 'project']),
+                         ['instance', 'historical_usage',
+                          'historical_usage_project', 'historical_usage_az',
+                          'project'])
+        index_rows = [
+            {'Key_name': 'PRIMARY', 'Seq_in_index': 1, 'Column_name': 'id',
+             'Non_unique': 0, 'Sub_part': None},
+            {'Key_name': 'usage_key', 'Seq_in_index': 2, 'Column_name': 'day',
+             'Non_unique': 1, 'Sub_part': None},
+            {'Key_name': 'usage_key', 'Seq_in_index': 1,
+             'Column_name': 'project_id', 'Non_unique': 1, 'Sub_part': None},
+            {'Key_name': 'name_key', 'Seq_in_index': 1, 'Column_name': 'name',
+             'Non_unique': 0, 'Sub_part': 10},
+        ]
+        self.assertEqual(BulkLoad.index_definitions(index_rows), {
+            'usage_key': "key `usage_key` (`project_id`, `day`)",
+            'name_key': "unique key `name_key` (`name`(10))",
+        })
+
+        cursor = DB.local_cursor.return_value
+        cursor.fetchall.return_value = index_rows
+        cursor.fetchone.return_value = {'value': 1}
+        BulkLoad.begin(['instance'], relaxed_durability=True)
+        statements = [c[0][0] for c in cursor.execute.call_args_list]
+        self.assertIn("alter table instance drop key `name_key`, "
+                      "drop key `usage_key`", statements)
+        self.assertIn("set session unique_checks = 0", statements)
+        self.assertEqual(DB.local_session, BulkLoad.session)
+        self.assertEqual(BulkLoad.saved_durability, 1)
+
+        cursor.execute.reset_mock()
+        cursor.fetchall.side_effect = [
+            [{'table_name': 'instance', 'index_name': 'name_key',
+              'definition': "unique key `name_key` (`name`(10))"},
+             {'table_name': 'instance', 'index_name': 'usage_key',
+              'definition': "key `usage_key` (`project_id`, `day`)"}],
+            # the unique index was rebuilt before we were interrupted
+            index_rows[:1] + index_rows[3:],
+        ]
+        BulkLoad.finish()
+        statements = [c[0] for c in cursor.execute.call_args_list]
+        self.assertIn(("set global innodb_flush_log_at_trx_commit = "
+                       "%(value)s", {'value': 1}),
+                      [(s[0], s[1]) for s in statements if len(s) > 1])
+        self.assertIn("alter table instance add key `usage_key` "
+                      "(`project_id`, `day`)", [s[0] for s in statements])
+        self.assertEqual(DB.local_session, [])
+        self.assertFalse(BulkLoad.active)
+        self.assertEqual(BulkLoad.saved_durability, None)
+
+    def test_sqlite_schema(self):
+        schema = (
+            "-- metadata\n"
+            "create table if not exists metadata (\n"
+            "  table_name varchar(64), -- a comment, with a comma\n"
+            "  last_update timestamp default current_timestamp "
+            "on update current_timestamp,\n"
+            "  row_count int(11) comment \"count(*)\",\n"
+            "  primary key (table_name)\n"
+            ") comment 'Database metadata';\n"
+            "create table if not exists `role` (\n"
+            "  role varchar(255) comment 'Role name',\n"
+            "  active boolean default false,\n"
+            "  primary key (role),\n"
+            "  key role_active_key (active)\n"
+            ") comment 'Roles';\n"
+        )
+        (statements, primary_keys) = translate_schema(schema)
+        self.assertEqual(primary_keys, {'metadata': ['table_name'],
+                                        'role': ['role']})
+        self.assertEqual(statements[0], (
+            "create table if not exists metadata (\n"
+            "    table_name varchar(64) not null,\n"
+            "    last_update timestamp default "
+            "(datetime('now', 'localtime')),\n"
+            "    row_count int(11),\n"
+            "    primary key (table_name)\n)"))
+        self.assertIn("after update on metadata", statements[2])
+        self.assertIn("active boolean default 0", statements[3])
+        self.assertEqual(statements[4], "create index if not exists "
+                                        "role_active_key on role (active)")
+
+    @patch('reporting_pollster.entities.entities.Config')
+    @patch('reporting_pollster.common.DB.Config')
+    def test_sqlite_local(self, DBConfig, Config):
+        DBConfig.get_local.return_value = {
+            'backend': 'sqlite', 'path': ':memory:',
+            'schema': 'data/reporting_schema_nectar.sql'}
+        DBConfig.get_local_backend.return_value = 'sqlite'
+        DB.local_conns.conn = None
+        args = MagicMock(full_run=True, last_update_window=0)
+        try:
+            inst = Instance(args)
+            day = datetime.datetime(2016, 2, 20)
+            rows = [{'day': day, 'vcpus': 2, 'memory': 4096,
+                     'local_storage': 30}]
+            # on duplicate key update is translated to an upsert
+            inst._load_many('hist_agg_add', copy.deepcopy(rows))
+            inst._load_many('hist_agg_add', copy.deepcopy(rows))
+            cursor = DB.local_cursor()
+            cursor.execute("select * from historical_usage")
+            self.assertEqual(cursor.fetchall(), [
+                {'day': day.date(), 'vcpus': 4, 'memory': 8192,
+                 'local_storage': 60, 'source': 'default'}])
+
+            last_update = datetime.datetime(2016, 3, 1, 12, 30)
+            inst.set_last_update(table='historical_usage',
+                                 last_update=last_update)
+            self.assertEqual(inst._get_last_update('historical_usage'),
+                             last_update)
+            cursor.execute(inst.metadata_query, ('historical_usage', ))
+            self.assertEqual(cursor.rowcount, 1)
+
+            # a null timestamp gets the current time, as it does in MySQL
+            hyp = Hypervisor(args)
+            hyp.data = [{'id': 1, 'availability_zone': 'az1',
+                         'host': 'test01', 'hostname': 'test01.test',
+                         'ip_address': '10.0.0.1', 'cpus': 8,
+                         'memory': 16384, 'local_storage': 500}]
+            hyp._load_many('update', hyp.data)
+            cursor.execute("select last_seen, active from hypervisor")
+            row = cursor.fetchone()
+            self.assertTrue(isinstance(row['last_seen'], datetime.datetime))
+            self.assertEqual(row['active'], 1)
+
+            # each source's metadata only counts that source's rows
+            hyp2 = Hypervisor(args, 'region2')
+            hyp2._load_many('update', [dict(hyp.data[0], id=2),
+                                       dict(hyp.data[0], id=3)])
+            for h in (hyp, hyp2):
+                h.this_update_start = last_update
+                h.set_last_update()
+            cursor.execute("select table_name, row_count from metadata "
+                           "where table_name like 'hypervisor%'")
+            self.assertEqual(sorted((r['table_name'], r['row_count'])
+                                    for r in cursor.fetchall()),
+                             [('hypervisor', 1), ('hypervisor@region2', 2)])
+        finally:
+            DB.local_conns.conn = None
+
+    @patch('reporting_pollster.entities.entities.Config')
+    @patch('reporting_pollster.common.DB.Config')
+    def test_data_versions(self, DBConfig, Config):
+        self.assertEqual(data_version({'a': 1, 'b': [1, 2]}),
+                         data_version({'b': [1, 2], 'a': 1}))
+        self.assertNotEqual(data_version({'a': 1}), data_version({'a': 2}))
+        DBConfig.get_local.return_value = {
+            'backend': 'sqlite', 'path': ':memory:',
+            'schema': 'data/reporting_schema_nectar.sql'}
+        DBConfig.get_local_backend.return_value = 'sqlite'
+        DB.local_conns.conn = None
+        args = MagicMock(full_run=True, last_update_window=0)
+        try:
+            Entity._cache_data('hypervisor_az', {'test01': 'az1'})
+            hyp = Hypervisor(args)
+            hyp.this_update_start = datetime.datetime.now()
+            hyp.data = [{'id': 1, 'availability_zone': 'az1',
+                         'host': 'test01', 'hostname': 'test01.test',
+                         'ip_address': '10.0.0.1', 'cpus': 8,
+                         'memory': 16384, 'local_storage': 500}]
+            with patch.object(hyp, '_load_active',
+                              wraps=hyp._load_active) as load:
+                hyp.load()
+                self.assertEqual(load.call_count, 1)
+                # nothing has changed, so the second load is skipped
+                hyp.load()
+                self.assertEqual(load.call_count, 1)
+                hyp.data[0]['cpus'] = 16
+                hyp.load()
+                self.assertEqual(load.call_count, 2)
+            cursor = DB.local_cursor()
+            cursor.execute("select name from data_version "
+                           "where consumer = 'hypervisor'")
+            self.assertEqual(sorted(r['name'] for r in cursor.fetchall()),
+                             ['hypervisor', 'hypervisor_az'])
+
+            # the active instances are remapped only when the AZ mapping
+            # changes - the first update just records the mapping
+            for (id, active) in (('i1', 1), ('i2', 0)):
+                cursor.execute("insert into instance (id, hypervisor, "
+                               "availability_zone, active, source) values "
+                               "(%s, 'test01', 'az0', %s, 'default')",
+                               (id, active))
+            inst = Instance(args)
+            inst.hypervisor_az_data = {'test01': 'az1'}
+            inst._remap_azs()
+            cursor.execute("select availability_zone from instance")
+            self.assertEqual([r['availability_zone']
+                              for r in cursor.fetchall()], ['az0', 'az0'])
+            inst.hypervisor_az_data = {'test01': 'az1', 'test02': 'az2'}
+            Entity._cache_data('hypervisor_az', inst.hypervisor_az_data)
+            inst._remap_azs()
+            cursor.execute("select id, availability_zone from instance "
+                           "order by id")
+            self.assertEqual([(r['id'], r['availability_zone'])
+                              for r in cursor.fetchall()],
+                             [('i1', 'az1'), ('i2', 'az0')])
+            cursor.execute("update instance set availability_zone = 'az0'")
+            inst._remap_azs()
+            cursor.execute("select availability_zone from instance "
+                           "where id = 'i1'")
+            self.assertEqual(cursor.fetchone()['availability_zone'], 'az0')
+        finally:
+            DB.local_conns.conn = None
+            Entity.drop_cached_data()
+
+    @patch('reporting_pollster.entities.entities.Config')
+    @patch('reporting_pollster.common.DB.Config')
+    def test_high_water_mark(self, DBConfig, Config):
+        DBConfig.get_local.return_value = {
+            'backend': 'sqlite', 'path': ':memory:',
+            'schema': 'data/reporting_schema_nectar.sql'}
+        DBConfig.get_local_backend.return_value = 'sqlite'
+        DB.local_conns.conn = None
+        Config.get_dbs.return_value = {"glance": "glance", "nova": "nova"}
+        args = MagicMock(full_run=True, last_update_window=86400)
+        try:
+            image = Image(args)
+            image.this_update_start = datetime.datetime(2016, 3, 1, 12, 10)
+            # no high water mark yet, so the window is used
+            image.set_last_update()
+            self.assertEqual(image.get_last_update(),
+                             datetime.datetime(2016, 2, 29, 12, 10))
+            # the source's timestamps are UTC, ten hours behind the local
+            # clock
+            hwm = datetime.datetime(2016, 3, 1, 2, 0, 30)
+            with patch.object(DB, 'remote_cursor') as remote_cursor:
+                cursor = remote_cursor.return_value
+                cursor.fetchall.return_value = [
+                    {'id': 'uuid1', 'changed_at': hwm},
+                    {'id': 'uuid2',
+                     'changed_at': hwm - datetime.timedelta(hours=1)}]
+                image.extract()
+                self.assertEqual(image.db_data, [{'id': 'uuid1'},
+                                                 {'id': 'uuid2'}])
+            image.set_last_update()
+            # the next extraction starts from the latest change the source
+            # recorded, less the margin
+            self.assertEqual(image.get_last_update(),
+                             datetime.datetime(2016, 3, 1, 1, 59, 30))
+            # and an update that finds no changes leaves the mark alone
+            with patch.object(DB, 'remote_cursor') as remote_cursor:
+                remote_cursor.return_value.fetchall.return_value = []
+                image.extract()
+            image.set_last_update()
+            self.assertEqual(image.get_last_update(),
+                             datetime.datetime(2016, 3, 1, 1, 59, 30))
+
+            # the usage is worked out from all the live instances, but only
+            # the ones changed since the last update are written back
+            inst = Instance(args)
+            inst.last_update = datetime.datetime(2016, 3, 1, 1, 59, 30)
+            inst.db_data = [
+                dict(instance_data[0], id='i1', changed_at=hwm),
+                dict(instance_data[1], id='i2',
+                     changed_at=hwm - datetime.timedelta(hours=1))]
+            inst._measure_high_water_mark()
+            inst.transform()
+            self.assertEqual([i['id'] for i in inst.data], ['i1'])
+            self.assertEqual(inst.hist_agg_data[0]['vcpus'], 2)
+
+            # a rebuild takes its mark from the latest change in the source
+            # when it was planned, and its segments cover the records created
+            # up to then
+            image.this_update_start = datetime.datetime(2016, 3, 2)
+            rebuild_mark = datetime.datetime(2016, 3, 2, 3, 0)
+            ranges = [[{'created': datetime.datetime(2016, 2, 1),
+                        'changed_at': rebuild_mark}]]
+            with patch.object(DB, 'remote_cursor') as remote_cursor:
+                remote_cursor.return_value.fetchall.side_effect = (
+                    lambda: ranges.pop(0) if ranges else [])
+                image.rebuild()
+                params = remote_cursor.return_value.execute.call_args[0][1]
+                self.assertEqual(params['segment_end'],
+                                 rebuild_mark + datetime.timedelta(seconds=1))
+            self.assertEqual(image.get_last_update(),
+                             datetime.datetime(2016, 3, 2, 2, 59))
+        finally:
+            DB.local_conns.conn = None
+
+    @patch('reporting_pollster.entities.entities.Config')
+    @patch('reporting_pollster.common.DB.Config')
+    def test_run_history(self, DBConfig, Config):
+        DBConfig.get_local.return_value = {
+            'backend': 'sqlite', 'path': ':memory:',
+            'schema': 'data/reporting_schema_nectar.sql'}
+        DBConfig.get_local_backend.return_value = 'sqlite'
+        Config.get_dbs.return_value = {"glance": "glance"}
+        DB.local_conns.conn = None
+        args = MagicMock(full_run=True, last_update_window=0)
+        images = [{'id': 'uuid%d' % (i), 'project_id': 'p1', 'name': 'img',
+                   'size': 10, 'status': 'active', 'public': 1,
+                   'created': datetime.datetime(2016, 1, 1), 'deleted': None,
+                   'active': 1} for i in range(3)]
+        try:
+            with patch.object(DB, 'remote_cursor') as remote_cursor:
+                cursor = remote_cursor.return_value
+                cursor.fetchall.return_value = images
+                Image(args).process()
+                cursor.execute.side_effect = MySQLError("gone away")
+                self.assertRaises(MySQLError, Image(args).process)
+            cursor = DB.local_cursor()
+            cursor.execute("select * from run_history order by started")
+            runs = cursor.fetchall()
+            self.assertEqual([(r['table_name'], r['mode'], r['rows_extracted'],
+                               r['rows_written']) for r in runs],
+                             [('image', 'full', 3, 3),
+                              ('image', 'incremental', 0, 0)])
+            self.assertEqual(runs[0]['error'], None)
+            self.assertIn("gone away", runs[1]['error'])
+            report = RunHistory.report(7)
+            self.assertIn("image: runs=2 full=1 errors=1", report)
+            self.assertIn("gone away", report)
+        finally:
+            DB.local_conns.conn = None
+
+        now = datetime.datetime(2016, 3, 10)
+        runs = [{'started': now - datetime.timedelta(days=d), 'mode': mode,
+                 'extract_time': t, 'transform_time': 0.0, 'load_time': 1.0,
+                 'export_time': 0.0, 'rows_written': 10, 'peak_rss': 0,
+                 'error': None}
+                for (d, t, mode) in [(5, 1.0, 'full'), (3, 1.0, 'incremental'),
+                                     (0.5, 4.0, 'incremental')]]
+        summary = RunHistory.summarise(runs, now)
+        self.assertEqual(summary['earlier_duration'], 2.0)
+        self.assertEqual(summary['recent_duration'], 5.0)
+        self.assertTrue(summary['regression'])
+
+    @patch('reporting_pollster.entities.entities.Config')
+    @patch('reporting_pollster.common.DB.Config')
+    def test_active_diff(self, DBConfig, Config):
+        DBConfig.get_local.return_value = {
+            'backend': 'sqlite', 'path': ':memory:',
+            'schema': 'data/reporting_schema_nectar.sql'}
+        DBConfig.get_local_backend.return_value = 'sqlite'
+        DB.local_conns.conn = None
+        args = MagicMock(full_run=True, last_update_window=0)
+        try:
+            agg = Aggregate(args)
+            agg.this_update_start = datetime.datetime(2016, 3, 1, 12, 0)
+            hosts = [{'id': 1, 'availability_zone': 'az1', 'host': 'test01'},
+                     {'id': 1, 'availability_zone': 'az1', 'host': 'test02'}]
+            agg.agg_host_data = copy.deepcopy(hosts)
+            agg.load()
+            # test01 goes away, test03 turns up - the ids can come back from
+            # the API as strings
+            agg.this_update_start = datetime.datetime(2016, 3, 1, 12, 10)
+            agg.agg_host_data = [
+                {'id': '1', 'availability_zone': 'az1', 'host': 'test02'},
+                {'id': 1, 'availability_zone': 'az1', 'host': 'test03'}]
+            with patch.object(agg, '_load_many',
+                              wraps=agg._load_many) as load_many:
+                agg.load()
+            self.assertEqual(
+                [(c[0][0], [r['host'] for r in c[0][1]])
+                 for c in load_many.call_args_list],
+                [('aggregate_host', ['test03']),
+                 ('aggregate_host_deactivate', ['test01'])])
+            cursor = DB.local_cursor()
+            cursor.execute("select host, active, last_seen from "
+                           "aggregate_host order by host")
+            rows = cursor.fetchall()
+            self.assertEqual([(r['host'], r['active']) for r in rows],
+                             [('test01', 0), ('test02', 1), ('test03', 1)])
+            # test01 was last seen by the previous update
+            self.assertEqual(rows[0]['last_seen'],
+                             datetime.datetime(2016, 3, 1, 12, 0))
+        finally:
+            DB.local_conns.conn = None
+
+    def test_status(self):
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, "status.sock")
+        entity = MagicMock(table='instance', source='default', mode=None,
+                           rows_extracted=100, rows_written=0, progress=None)
+        try:
+            Status.serve(socket_path=path)
+            Status.start_poll(600)
+            Status.queue('default', ['aggregate', 'instance', 'volume'])
+            Status.start_table(entity, expected=60.0)
+            Status.phase(entity, 'transform')
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(path)
+            client.sendall("GET / HTTP/1.0\r\n\r\n")
+            response = ""
+            while True:
+                data = client.recv(4096)
+                if not data:
+                    break
+                response += data
+            client.close()
+            (headers, body) = response.split("\r\n\r\n", 1)
+            self.assertIn("200", headers.splitlines()[0])
+            status = json.loads(body)
+            self.assertEqual(status['queued'], {'default': ['aggregate',
+                                                            'volume']})
+            current = status['current']['default']
+            self.assertEqual((current['table'], current['phase'],
+                              current['rows_extracted']),
+                             ('instance', 'transform', 100))
+            self.assertTrue(current['eta'])
+            self.assertEqual(status['poll']['overdue'], 0.0)
+
+            Status.finish_table(entity, 'instance')
+            Status.finish_poll(True)
+            status = Status.snapshot()
+            self.assertEqual(status['current'], {})
+            self.assertIn('instance', status['refreshed'])
+            self.assertTrue(status['last_poll']['completed'])
+        finally:
+            Status.stop()
+            shutil.rmtree(tmpdir)
+        self.assertFalse(os.path.exists(path))
+
+    @patch('reporting_pollster.common.DB.DB.kill_remote_query')
+    def test_deadlines(self, kill_remote_query):
+        try:
+            Deadline.configure({'query': '0.05', 'project': '30'},
+                               entity_timeout=600)
+            self.assertEqual(Deadline.table_timeouts, {'project': 30.0})
+            self.assertEqual(Deadline.hint("SELECT id from instances", 1.5),
+                             "select /*+ MAX_EXECUTION_TIME(1500) */ id "
+                             "from instances")
+            self.assertEqual(Deadline.hint("kill query 1", 1.5),
+                             "kill query 1")
+            self.assertEqual(Deadline.query_budget('default'), 0.05)
+            Deadline.start('default', 'project')
+            self.assertTrue(29 < Deadline.remaining('default') <= 30)
+
+            # a query that runs over its budget is killed on the server
+            cursor = MagicMock()
+            cursor.connection.thread_id.return_value = 42
+
+            def execute(query, args):
+                time.sleep(0.2)
+                raise MySQLError(1317, "Query execution was interrupted")
+            cursor.execute.side_effect = execute
+            ic = InstrumentedCursor(cursor, 'remote')
+            self.assertRaises(DeadlineExceeded, ic.execute,
+                              "select * from quotas", name='project.query')
+            kill_remote_query.assert_called_once_with('default', 42)
+            self.assertIn("MAX_EXECUTION_TIME(50)",
+                          cursor.execute.call_args[0][0])
+            # other errors are passed through
+            cursor.execute.side_effect = MySQLError(1146, "No such table")
+            self.assertRaises(MySQLError, ic.execute, "select 1")
+
+            # once the entity is out of time no more queries are run
+            Deadline._deadlines['default'] = (
+                'project', datetime.datetime.now())
+            cursor.execute.reset_mock()
+            self.assertRaises(DeadlineExceeded, ic.execute, "select 1")
+            self.assertFalse(cursor.execute.called)
+            Deadline.finish('default')
+            self.assertEqual(Deadline.remaining('default'), None)
+        finally:
+            Deadline.configure({})
+
+    @patch('reporting_pollster.entities.entities.Config')
+    @patch('reporting_pollster.common.DB.Config')
+    def test_api_cache(self, DBConfig, Config):
+        DBConfig.get_local.return_value = {
+            'backend': 'sqlite', 'path': ':memory:',
+            'schema': 'data/reporting_schema_nectar.sql'}
+        DBConfig.get_local_backend.return_value = 'sqlite'
+        DB.local_conns.conn = None
+        tmpdir = tempfile.mkdtemp()
+        aggregates = [ReplayResource({
+            'id': 1, 'availability_zone': 'az1', 'name': 'agg1',
+            'created_at': None, 'deleted_at': None, 'deleted': False,
+            'hosts': ['test01.test'], 'metadata': {'updated': 1}})]
+        client = MagicMock()
+        client.aggregates.list.return_value = aggregates
+        client.hypervisors.list.return_value = []
+        args = MagicMock(full_run=True, last_update_window=0)
+        try:
+            ApiCache.configure(tmpdir, 600)
+            self.assertEqual(Entity.get_api_calls(
+                ['aggregate', 'hypervisor'], Namespace()),
+                ['aggregates.list'])
+            ApiCache.prefetch('default', lambda: client,
+                              ['aggregates.list', 'hypervisors.list'])
+            self.assertEqual(ApiCache.fetch('default', 'hypervisors.list',
+                                            None), [])
+            agg = Aggregate(args)
+            agg.novaclient = client
+            agg.this_update_start = datetime.datetime.now()
+            agg.extract()
+            agg.transform()
+            with patch.object(agg, '_load_simple') as load:
+                agg.load()
+                self.assertEqual(load.call_count, 1)
+                # the fields the pollster doesn't use can change without
+                # forcing a load
+                aggregates[0].metadata = {'updated': 2}
+                agg = Aggregate(args)
+                agg.novaclient = client
+                agg.this_update_start = datetime.datetime.now()
+                agg.extract()
+                agg.transform()
+                agg.load()
+                self.assertEqual(load.call_count, 1)
+            self.assertEqual(Entity._get_cached_data('hypervisor_az'),
+                             {'test01': 'az1'})
+
+            # failures fall back to the last good response on disk, as long
+            # as it's recent enough
+            ApiCache.configure(tmpdir, 600)
+            client.aggregates.list.side_effect = Exception("unavailable")
+            cached = ApiCache.fetch('default', 'aggregates.list', client)
+            self.assertEqual([(a.id, a.hosts) for a in cached],
+                             [(1, ['test01.test'])])
+            with patch('reporting_pollster.common.apicache.time') as t:
+                t.time.return_value = time.time() + 601
+                self.assertRaises(Exception, ApiCache.fetch, 'default',
+                                  'aggregates.list', client)
+        finally:
+            DB.local_conns.conn = None
+            Entity.drop_cached_data()
+            ApiCache.configure()
+            shutil.rmtree(tmpdir)
+
+    @patch('reporting_pollster.common.throttle.time')
+    def test_throttle(self, fake_time):
+        clock = [1000.0]
+        sleeps = []
+
+        def sleep(delay):
+            sleeps.append(delay)
+            clock[0] += delay
+        fake_time.time.side_effect = lambda: clock[0]
+        fake_time.sleep.side_effect = sleep
+        settings = {'rows_per_second': '1000', 'threads_running': '10',
+                    'check_interval': '0'}
+        with patch.multiple(Throttle, queries_per_second=None,
+                            rows_per_second=None, threads_running=None,
+                            check_interval=10.0):
+            Throttle.configure(settings)
+            cursor = MagicMock(rowcount=3000)
+            cursor.fetchone.return_value = {'Variable_name': 'Threads_running',
+                                            'Value': '4'}
+            ic = InstrumentedCursor(cursor, 'remote')
+            ic.execute("select * from instances", name='instance.query')
+            self.assertEqual(cursor.execute.call_count, 2)
+            self.assertEqual(sleeps, [])
+            # the rows from the first query have to be paid for first
+            ic.execute("select * from instances", name='instance.query')
+            self.assertEqual(sleeps, [2.0])
+            self.assertEqual(Throttle.total_wait(), 2.0)
+            # a busy source cuts the rate back
+            cursor.fetchone.return_value = {'Variable_name': 'Threads_running',
+                                            'Value': '40'}
+            ic.execute("select * from volumes", name='volume.query')
+            self.assertEqual(Throttle._state['default']['backoff'], 2.0)
+            # the latency of a query is judged against its usual latency
+            Throttle.record('default', 'project.query', 0.2, 0)
+            Throttle.record('default', 'project.query', 1.0, 0)
+            self.assertEqual(Throttle._state['default']['backoff'], 4.0)
+            Throttle.record('default', 'project.query', 0.3, 0)
+            self.assertEqual(Throttle._state['default']['backoff'], 3.2)
+            # local queries aren't throttled
+            local = MagicMock(rowcount=1)
+            InstrumentedCursor(local, 'local').execute("select 1")
+            self.assertEqual(local.execute.call_count, 1)
+            Throttle.configure({})
+        self.assertFalse(Throttle.enabled())
+
+    @patch('reporting_pollster.entities.entities.DB')
+    @patch('reporting_pollster.entities.entities.Config')
+    def test_extract_with_subqueries(self, Config, DB):
+        Config.get_dbs.return_value = {"keystone": "keystone"}
+        DB.pooled_cursor.return_value.fetchall.return_value = (
+            project_allocations)
+        allocs = Allocation(MagicMock(full_run=True))
+
+        def extract_main():
+            allocs.db_data = alloc_data
+        allocs._extract_with_subqueries(extract_main)
+        self.assertEqual(allocs.db_data, alloc_data)
+        self.assertEqual(allocs.tenant_allocation_data, project_allocations)
+        self.assertEqual(DB.release_remote_connection.call_count, 1)
+
+        # errors in the concurrent queries are passed back to the caller
+        DB.pooled_cursor.return_value.execute.side_effect = ValueError()
+        self.assertRaises(ValueError, allocs._extract_with_subqueries,
+                          extract_main)
+
+    @patch.object(Config, '_get_nova_client')
+    @patch.object(DB, 'remote')
+    def test_record_replay(self, remote, get_nova_client):
+        class Resource(object):
+            def __init__(self, info):
+                self.info = info
+
+            def to_dict(self):
+                return dict(self.info)
+
+        rows = [{'id': 1, 'created': datetime.datetime(2016, 1, 1)},
+                {'id': 2, 'created': datetime.datetime(2016, 1, 2)}]
+        real_cursor = remote.return_value.cursor.return_value
+        real_cursor.fetchall.return_value = rows
+        real_cursor.rowcount = 2
+        client = get_nova_client.return_value
+        client.hypervisors.list.return_value = [
+            Resource({'id': 3, 'hypervisor_hostname': 'test01.test'})]
+        directory = tempfile.mkdtemp()
+        try:
+            Replay.start_recording(directory)
+            cursor = DB.remote_cursor(source='region2')
+            cursor.execute("select id, created from instances",
+                           {'last_update': None}, name="instance.query")
+            self.assertEqual(cursor.fetchone(), rows[0])
+            self.assertEqual(cursor.fetchall(), rows[1:])
+            nova = Config.get_nova_client(source='region2')
+            self.assertEqual(nova.hypervisors.list()[0].to_dict(),
+                             {'id': 3, 'hypervisor_hostname': 'test01.test'})
+            Replay.save()
+            # each poll is saved separately, and replayed in order
+            real_cursor.fetchall.return_value = rows[:1]
+            cursor.execute("select id, created from instances",
+                           {'last_update': None}, name="instance.query")
+            Replay.save()
+            self.assertEqual(Replay._data, {})
+            self.assertEqual(sorted(os.listdir(directory)),
+                             ['poll0001', 'poll0002'])
+            Replay.stop()
+
+            remote.reset_mock()
+            get_nova_client.reset_mock()
+            Replay.start_replay(directory)
+            cursor = DB.remote_cursor(source='region2')
+            cursor.execute("select id, created from instances",
+                           {'last_update': datetime.datetime.now()},
+                           name="instance.query")
+            self.assertEqual(cursor.rowcount, 2)
+            self.assertEqual(cursor.fetchall(), rows)
+            cursor.execute("select id, created from instances",
+                           {'last_update': datetime.datetime.now()},
+                           name="instance.query")
+            self.assertEqual(cursor.fetchall(), rows[:1])
+            hypervisors = Config.get_nova_client(
+                source='region2').hypervisors.list()
+            self.assertEqual(hypervisors[0].hypervisor_hostname,
+                             'test01.test')
+            self.assertFalse(remote.called)
+            self.assertFalse(get_nova_client.called)
+            self.assertRaises(ReplayError, cursor.execute, "select 1")
+            self.assertRaises(ReplayError, DB.remote_cursor().execute,
+                              "select id, created from instances")
+        finally:
+            Replay.stop()
+            shutil.rmtree(directory)
+
+    @patch('reporting_pollster.entities.entities.DB')
+    @patch('reporting_pollster.entities.entities.Config')
+    def test_nova_cells(self, Config, DB):
+        Config.get_dbs.return_value = {"nova": "nova", "nova_api": "nova_api"}
+        DB.remote_cursor.return_value.fetchall.return_value = [
+            {'name': 'cell0', 'uuid': 'uuid0',
+             'database_connection': 'mysql+pymysql://nova:pw@db/nova_cell0'},
+            {'name': 'cell1', 'uuid': 'uuid1',
+             'database_connection':
+                'mysql+pymysql://nova:pw@db/nova_cell1?charset=utf8'},
+            {'name': None, 'uuid': 'uuid2', 'database_connection': None},
+        ]
+        cell_rows = {
+            'nova_cell0': [{'id': 'i3', 'created': datetime.datetime(2016, 3,
+                                                                     1)}],
+            'nova_cell1': [
+                {'id': 'i1', 'created': datetime.datetime(2016, 1, 1)},
+                {'id': 'i2', 'created': datetime.datetime(2016, 5, 1)},
+            ],
+        }
+
+        def pooled_cursor(conn, source):
+            cursor = MagicMock()
+
+            def execute(query, params, name):
+                db = query.split(' from ')[1].split('.')[0]
+                cursor.fetchall.return_value = [dict(r) for r in cell_rows[db]]
+            cursor.execute.side_effect = execute
+            return cursor
+        DB.pooled_cursor.side_effect = pooled_cursor
+
+        args = Namespace(full_run=True, last_update_window=0, nova_cells=True)
+        with patch.object(Entity, '_cache', {}):
+            inst = Instance(args)
+            inst._extract_all()
+            self.assertEqual([r['id'] for r in inst.db_data],
+                             ['i1', 'i3', 'i2'])
+            self.assertEqual([r['cell_name'] for r in inst.db_data],
+                             ['cell1', 'cell0', 'cell1'])
+            self.assertEqual(DB.release_remote_connection.call_count, 2)
+            # discovery happens once per polling run
+            inst._extract_all()
+            self.assertEqual(DB.remote_cursor.return_value.execute.call_count,
+                             1)
+            # cell0 is normally empty, so its segment range is null
+            cell_rows['nova_cell0'] = [{'created': None}]
+            cell_rows['nova_cell1'] = [
+                {'created': datetime.datetime(2016, 1, 1, 12)}]
+            inst.this_update_start = datetime.datetime(2016, 3, 1)
+            segments = inst._plan_rebuild('instance')
+            self.assertEqual(segments[0]['segment_start'],
+                             datetime.datetime(2016, 1, 1))
+
+        # without the flag nothing changes
+        args.nova_cells = False
+        inst = Instance(args)
+        inst._extract_all()
+        query = DB.remote_cursor.return_value.execute.call_args[0][0]
+        self.assertIn("from nova.instances", query)
+
+    @patch('reporting_pollster.common.config.verify_nova_creds')
+    def test_config_sources(self, verify):
+        parser = SafeConfigParser()
+        parser.add_section('remote:region2')
+        parser.set('remote:region2', 'host', 'db.region2')
+        parser.set('remote:region2', 'port', '3307')
+        parser.add_section('nova:region2')
+        parser.set('nova:region2', 'region_name', 'region2')
+        with patch.object(Config, 'remote', {'host': 'db.default'}), \
+                patch.object(Config, 'nova', {'username': 'user'}), \
+                patch.object(Config, 'remote_sources', {}), \
+                patch.object(Config, 'nova_sources', {}):
+            Config.load_sources(parser)
+            self.assertEqual(Config.get_sources(), ['default', 'region2'])
+            self.assertEqual(Config.get_remote(),
+                             {'host': 'db.default'})
+            self.assertEqual(Config.get_remote('region2'),
+                             {'host': 'db.region2', 'port': 3307})
+            self.assertEqual(Config.get_nova('region2'),
+                             {'username': 'user', 'region_name': 'region2'})
+
+    @patch('reporting_pollster.entities.entities.Config')
+    def test_sources(self, Config):
+        inst = Instance(self.args, 'region2')
+        self.assertEqual(inst._metadata_key('instance'), 'instance@region2')
+        self.assertEqual(inst._source_key('has_instance'),
+                         'has_instance@region2')
+        rows = [{'id': 'i_uuid1'}]
+        inst._tag_source(rows)
+        self.assertEqual(rows[0]['source'], 'region2')
+        inst = Instance(self.args)
+        self.assertEqual(inst._metadata_key('instance'), 'instance')
+        # only regional data is tagged
+        proj = Project(self.args, 'region2')
+        rows = [{'id': 'uuid1'}]
+        proj._tag_source(rows)
+        self.assertEqual(rows[0], {'id': 'uuid1'})
+        self.assertTrue(Entity.is_regional('instance'))
+        self.assertFalse(Entity.is_regional('project'))
+        # project reads the local instance table, which the additional
+        # sources load
+        self.assertTrue(Entity.depends_on_regional('project'))
+        self.assertTrue(Entity.depends_on_regional('hypervisor_utilisation'))
+        self.assertFalse(Entity.depends_on_regional('allocation'))
+
     def test_table_dependencies(self):
         # Note: these tests may be too dependent on how sort() deals with
         # elements that compare equal to be reliable! It may need to be pared
@@ -600,6 +1879,7 @@ class test_all(unittest.TestCase):
             'volume',
             'hypervisor',
             'instance',
+            'hypervisor_utilisation',
             'project'
             ],
             Entity.get_table_names())
@@ -609,10 +1889,18 @@ class test_all(unittest.TestCase):
                 Entity.get_table_names(user_tables=['allocation']))
         self.assertEqual(['aggregate', 'instance'],
                 Entity.get_table_names(user_tables=['instance']))
-        self.assertEqual(['aggregate', 'instance', 'project'],
+        # project reads has_instances from the local instance table, so it
+        # doesn't drag in an instance update
+        self.assertEqual(['project'],
                 Entity.get_table_names(user_tables=['project']))
+        # but it's processed after instance when they're both requested
+        self.assertEqual(['aggregate', 'instance', 'project'],
+                Entity.get_table_names(user_tables=['project', 'instance']))
         self.assertEqual(['aggregate', 'hypervisor'],
                 Entity.get_table_names(user_tables=['hypervisor']))
+        self.assertEqual(['aggregate', 'instance', 'hypervisor_utilisation'],
+                Entity.get_table_names(
+                    user_tables=['hypervisor_utilisation']))
 
 
 if __name__ == '__main__':